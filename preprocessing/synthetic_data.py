@@ -0,0 +1,102 @@
+import os
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+from tqdm import tqdm
+
+# PARAMETERS
+CHUNK_SIZE = 64     # images generated per vectorized call / worker task
+
+
+def class_params(n_classes, seed=0):
+    """
+    per-class pattern parameters: base color, stripe orientation and frequency
+    spread evenly so the classes are easy to separate
+    """
+    rng = np.random.RandomState(seed)
+    hues = (np.arange(n_classes) + rng.uniform(0, 0.5)) / n_classes
+    colors = np.stack([0.5 + 0.5 * np.cos(2 * np.pi * (hues + k / 3.0)) for k in range(3)], -1)
+    angles = np.pi * ((np.arange(n_classes) * 0.618) % 1.0)
+    freqs = 2.0 + 6.0 * ((np.arange(n_classes) * 0.382) % 1.0)
+    return colors.astype('float32'), angles.astype('float32'), freqs.astype('float32')
+
+
+def generate_images(labels, resolution, params, rng, noise=0.08):
+    """
+    generates a batch of uint8 images for the given labels in one vectorized pass
+    each image is a stripe pattern in its class color with random phase,
+    small orientation/frequency jitter and pixel noise
+    """
+    colors, angles, freqs = params
+    n = len(labels)
+    coords = np.linspace(0, 1, resolution, dtype='float32')
+    yy, xx = np.meshgrid(coords, coords, indexing='ij')
+    theta = (angles[labels] + rng.normal(0, 0.05, n).astype('float32'))[:, None, None]
+    freq = (freqs[labels] * rng.uniform(0.9, 1.1, n).astype('float32'))[:, None, None]
+    phase = rng.uniform(0, 2 * np.pi, n).astype('float32')[:, None, None]
+    pattern = np.sin(2 * np.pi * freq * (xx * np.cos(theta) + yy * np.sin(theta)) + phase)
+    img = colors[labels][:, None, None, :] * (0.6 + 0.4 * pattern[..., None])
+    img += rng.normal(0, noise, img.shape).astype('float32')
+    return (np.clip(img, 0, 1) * 255).astype('uint8')
+
+
+def write_chunk(task):
+    """generates one chunk and writes it as jpgs into class folders or as one npz shard"""
+    split_dir, labels, start, resolution, n_classes, seed, shards, quality = task
+    rng = np.random.RandomState(seed)
+    images = generate_images(labels, resolution, class_params(n_classes), rng)
+    if shards:
+        np.savez(os.path.join(split_dir, 'shard-%07d.npz' % start), x=images, y=labels)
+    else:
+        for i, (img, label) in enumerate(zip(images, labels)):
+            path = os.path.join(split_dir, 'class%02d' % label, '%07d.jpg' % (start + i))
+            Image.fromarray(img).save(path, quality=quality)
+    return len(labels)
+
+
+def make_synthetic_dataset(base_path, n_train=100000, n_test=20000, resolution=64, n_classes=5,
+                           workers=None, shards=False, quality=90, seed=0):
+    """
+    writes base_path/train/<class> and base_path/test/<class> jpg trees
+    (or base_path/<split>/shard-*.npz files with x/y arrays when shards=True)
+    returns the number of images written
+    """
+    tasks = []
+    for split, n, split_seed in [('train', n_train, seed), ('test', n_test, seed + 1)]:
+        split_dir = os.path.join(base_path, split)
+        os.makedirs(split_dir, exist_ok=True)
+        for c in range(0 if shards else n_classes):
+            os.makedirs(os.path.join(split_dir, 'class%02d' % c), exist_ok=True)
+        labels = np.arange(n) % n_classes
+        for start in range(0, n, CHUNK_SIZE):
+            chunk_seed = (split_seed * 1000003 + start) % 2 ** 32
+            tasks.append((split_dir, labels[start:start + CHUNK_SIZE], start, resolution,
+                          n_classes, chunk_seed, shards, quality))
+
+    start = time.time()
+    written = 0
+    with Pool(workers) as pool:
+        for count in tqdm(pool.imap_unordered(write_chunk, tasks), total=len(tasks), desc='Writing images'):
+            written += count
+    elapsed = time.time() - start
+    print("Wrote %d images to %s in %0.1fs (%0.0f images/sec)" % (written, base_path, elapsed, written / elapsed))
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline synthetic image dataset for pipeline benchmarking")
+    parser.add_argument('base_path')
+    parser.add_argument('--n-train', type=int, default=100000)
+    parser.add_argument('--n-test', type=int, default=20000)
+    parser.add_argument('--resolution', type=int, default=64)
+    parser.add_argument('--n-classes', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shards', action='store_true', help="write packed npz shards instead of jpgs")
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    make_synthetic_dataset(args.base_path, args.n_train, args.n_test, args.resolution, args.n_classes,
+                           workers=args.workers, shards=args.shards, quality=args.quality, seed=args.seed)
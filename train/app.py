@@ -1,14 +1,17 @@
 import flask
+import io
 import json
 import os
 import time
+import queue
+import math
+import threading
+import collections
+from uuid import uuid4
 import test_cyclegan as cgan
 import numpy as np
-from skimage.io import imsave
-from skimage.transform import resize
-from PIL import Image, ImageFile
-from gevent.event import AsyncResult, Timeout
-from gevent.queue import Empty, Queue
+from PIL import Image
+from event_hub import EventHub
 from shutil import rmtree
 from hashlib import sha1
 from stat import S_ISREG, ST_CTIME, ST_MODE
@@ -18,13 +21,29 @@ DATA_DIR = 'demo_data'
 KEEP_ALIVE_DELAY = 25
 MAX_IMAGE_SIZE = 800, 600
 MAX_IMAGES = 20
-MAX_DURATION = 300
 MAX_DIFF = 1.25
 IMAGE_PADDING = 7
-MODEL = "cubism_v1"
+OUTPUT_FORMAT = 'JPEG'  # or 'WEBP'
+OUTPUT_QUALITY = 85
+OUTPUT_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+MODEL = "cubism_v1"     # default style, requests pick another with ?model=&epoch=
+EPOCH = 200
+STYLE_REFRESH_DELAY = 60    # seconds between checks of the checkpoints folder for new styles
+STYLIZE_WORKERS = cgan.MAX_PARALLEL_JOBS   # uploads stylized concurrently, the rest wait in job_queue
+MAX_JOB_RECORDS = 200   # finished jobs kept for /jobs/<id>
+MAX_UPLOAD_BYTES = 8 * 2 ** 20
+MAX_PENDING_JOBS = 16   # queued + running stylizations before /post answers 503
+CLIENT_RATE = 0.2       # uploads per second per client, token bucket refill rate
+CLIENT_BURST = 3        # uploads a client may make back to back
 
 app = flask.Flask(__name__, static_folder=DATA_DIR)
-broadcast_queue = Queue()
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+hub = EventHub(overflow='disconnect')  # slow clients reconnect and replay via Last-Event-ID
+job_queue = queue.Queue()
+jobs = collections.OrderedDict()    # job id -> status record, oldest first
+inflight = {}                       # target path -> id of the job producing it
+job_seconds = [10.0]                # moving average of stylization time, for Retry-After
+jobs_lock = threading.Lock()
 
 
 #try:  # Reset saved files on each start
@@ -35,37 +54,9 @@ broadcast_queue = Queue()
 
 
 def broadcast(message):
-    """Notify all waiting waiting gthreads of message."""
-    waiting = []
-    try:
-        while True:
-            waiting.append(broadcast_queue.get(block=False))
-    except Empty:
-        pass
-    print('Broadcasting {0} messages'.format(len(waiting)))
-    for item in waiting:
-        item.set(message)
-
-
-def receive():
-    """Generator that yields a message at least every KEEP_ALIVE_DELAY seconds.
-    yields messages sent by `broadcast`.
-    """
-    now = time.time()
-    end = now + MAX_DURATION
-    tmp = None
-    # Heroku doesn't notify when client disconnect so we have to impose a
-    # maximum connection duration.
-    while now < end:
-        if not tmp:
-            tmp = AsyncResult()
-            broadcast_queue.put(tmp)
-        try:
-            yield tmp.get(timeout=KEEP_ALIVE_DELAY)
-            tmp = None
-        except Timeout:
-            yield ''
-        now = time.time()
+    """Notify all stream subscribers of message."""
+    event_id = hub.publish(message)
+    print('Broadcast event {0} to {1} subscribers'.format(event_id, len(hub)))
 
 
 def safe_addr(ip_addr):
@@ -91,85 +82,364 @@ def correct_image_ratio(img, ratio=1.5):
   return img
 
 
-def save_normalized_image(path, data):
-    image_parser = ImageFile.Parser()
+def parse_style(args):
+    """
+    returns the (model, epoch) requested in args, defaulting to MODEL and to
+    EPOCH or the model's latest epoch; raises ValueError for unknown styles
+    """
+    model = args.get('model', MODEL)
+    epochs = cgan.CATALOG.epochs(model) if model in cgan.CATALOG.names() else []
+    if not epochs:
+        raise ValueError('unknown style {0}'.format(model))
+    epoch = args.get('epoch') or (str(EPOCH) if str(EPOCH) in epochs else epochs[-1])
+    if epoch not in epochs:
+        raise ValueError('{0} has no epoch {1}'.format(model, epoch))
+    return model, epoch
+
+
+def decode_upload(data):
+    """
+    decodes an upload to an RGB image no larger than MAX_IMAGE_SIZE; large
+    JPEGs are decoded at a reduced scale (draft mode) before the final resample
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', MAX_IMAGE_SIZE)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail(MAX_IMAGE_SIZE, Image.BILINEAR)
+    return image
+
+
+def encode_image(path, image_np):
+    """writes path atomically as OUTPUT_FORMAT at OUTPUT_QUALITY"""
+    options = {'quality': OUTPUT_QUALITY}
+    if OUTPUT_FORMAT == 'JPEG':
+        options.update(progressive=True, optimize=True)
+    tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+    Image.fromarray(image_np).save(tmp_path, OUTPUT_FORMAT, **options)
+    os.replace(tmp_path, path)
+
+
+def save_normalized_image(path, data, model=MODEL, epoch=EPOCH):
     try:
-        image_parser.feed(data)
-        image = image_parser.close()
+        image = decode_upload(data)
     except IOError:
         raise
         return False
-    image.thumbnail(MAX_IMAGE_SIZE, Image.ANTIALIAS)
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
 
-    image_np = np.array(image)
+    image_np = np.asarray(image)
     image_np = correct_image_ratio(image_np, ratio=MAX_DIFF)
 
-    opts = cgan.create_options(MODEL, epoch=200)
+    opts = cgan.create_options(model, epoch=epoch)
     print(image_np.shape)
-    image_stylized = cgan.test(image_np, opts) / 255.0
-    image_original_resize = resize(image_np, image_stylized.shape)
-    padding = np.zeros((image_stylized.shape[0], IMAGE_PADDING, 3))
+    image_stylized = np.asarray(cgan.cached_test(image_np, opts))[:, :, :3]
+    h, w = image_stylized.shape[:2]
+    image_original_resize = Image.fromarray(image_np).resize((w, h), Image.BILINEAR)
 
-    # print("STYLIZED IMAGE......", image_stylized.shape, image_stylized)
-    # print("ORIGINAL RESIZED IMAGE........", image_original_resize.shape, image_original_resize)
-    combined_img = np.concatenate([image_stylized, padding, image_original_resize], 1)
+    # stylized | padding | original, composed in one uint8 buffer
+    combined_img = np.zeros((h, 2 * w + IMAGE_PADDING, 3), dtype=np.uint8)
+    combined_img[:, :w] = image_stylized
+    combined_img[:, w + IMAGE_PADDING:] = np.asarray(image_original_resize)
 
-    imsave(path, combined_img)
+    encode_image(path, combined_img)
     return True
 
 
-def event_stream(client):
-    force_disconnect = False
+class Gallery:
+    """
+    the most recent results, newest first, kept in memory with the rendered
+    html cached until the next change; files pushed out of the gallery are
+    deleted by a background thread
+    """
+
+    def __init__(self, data_dir=DATA_DIR, size=MAX_IMAGES):
+        self.data_dir = data_dir
+        self.size = size
+        self.paths = collections.deque()
+        self.fragment = None
+        self.lock = threading.Lock()
+        self.evicted = queue.Queue()
+
+    def load(self):
+        """rebuilds the gallery from DATA_DIR, oldest files beyond size are queued for deletion"""
+        # Code adapted from: http://stackoverflow.com/questions/168409/
+        os.makedirs(self.data_dir, exist_ok=True)
+        image_infos = []
+        for filename in os.listdir(self.data_dir):
+            filepath = os.path.join(self.data_dir, filename)
+            file_stat = os.stat(filepath)
+            if S_ISREG(file_stat[ST_MODE]) and not filename.endswith('.tmp'):
+                image_infos.append((file_stat[ST_CTIME], filepath))
+        with self.lock:
+            for _, path in sorted(image_infos):
+                self.push(path)
+
+    def push(self, path):
+        """caller holds the lock"""
+        if path in self.paths:
+            self.paths.remove(path)
+        self.paths.appendleft(path)
+        while len(self.paths) > self.size:
+            self.evicted.put(self.paths.pop())
+        self.fragment = None
+
+    def add(self, path):
+        with self.lock:
+            self.push(path)
+
+    def keep(self, path):
+        """moves an existing result to the front, False if it isn't on disk"""
+        with self.lock:
+            if not os.path.exists(path):
+                return False
+            self.push(path)
+            return True
+
+    def html(self):
+        with self.lock:
+            if self.fragment is None:
+                self.fragment = '\n'.join(
+                    '<div id="images"><img alt="User uploaded image" src="{0}" /></div>'.format(path)
+                    for path in self.paths)
+            return self.fragment
+
+    def cleanup(self):
+        while True:
+            path = self.evicted.get()
+            with self.lock:
+                if path in self.paths:  # uploaded again since it was evicted
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def start(self):
+        self.load()
+        threading.Thread(target=self.cleanup, daemon=True).start()
+
+
+gallery = Gallery()
+class StyleOptions:
+    """
+    <option> tags for the style selector; a background thread rebuilds them
+    when the catalog's models change, so pages never touch the filesystem
+    """
+
+    def __init__(self, delay=STYLE_REFRESH_DELAY):
+        self.delay = delay
+        self.models = None
+        self.fragment = ''
+
+    def refresh(self):
+        models = sorted(cgan.CATALOG.models())
+        if models != self.models:
+            self.fragment = ''.join(
+                '<option{0}>{1}</option>'.format(' selected' if model == MODEL else '', model)
+                for model in models)
+            self.models = models
+
+    def refresher(self):
+        while True:
+            time.sleep(self.delay)
+            try:
+                self.refresh()
+            except OSError as e:
+                print('Could not list styles: {0}'.format(e))
+
+    def html(self):
+        return self.fragment
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self.refresher, daemon=True).start()
+
+
+style_options = StyleOptions()
+
+
+class Rejected(Exception):
+    """a request turned away by admission control, answered with Retry-After"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class RateLimiter:
+    """
+    token bucket per client: rate uploads per second with bursts up to burst,
+    only the max_clients most recently seen clients are tracked
+    """
+
+    def __init__(self, rate=CLIENT_RATE, burst=CLIENT_BURST, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()    # client -> (tokens, timestamp)
+        self.lock = threading.Lock()
+
+    def take(self, client):
+        """spends a token for client, raises Rejected when there is none"""
+        now = time.time()
+        with self.lock:
+            tokens, stamp = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        if not allowed:
+            raise Rejected('too many uploads, slow down', 429, (1 - tokens) / self.rate)
+
+
+rate_limiter = RateLimiter()
+
+
+def validate_upload(data):
+    """raises ValueError unless data looks like an image PIL can open"""
+    if not data:
+        raise ValueError('empty upload')
     try:
-        for message in receive():
-            yield 'data: {0}\n\n'.format(message)
-        print('{0} force closing stream'.format(client))
-        force_disconnect = True
+        Image.open(io.BytesIO(data)).verify()
+    except Exception:
+        raise ValueError('unsupported image')
+
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        jobs[job_id].update(fields, updated=time.time())
+
+
+def submit_job(target, data, model, epoch, client):
+    """
+    queues an upload for stylization unless the same image and style is in flight,
+    which shares that job, or already on disk, which is broadcast right away
+    raises Rejected when MAX_PENDING_JOBS stylizations are already queued or running
+    returns (job id, whether the model has to run)
+    """
+    with jobs_lock:
+        if target in inflight:
+            return inflight[target], True
+        job_id = uuid4().hex
+        done = gallery.keep(target)
+        if not done and len(inflight) >= MAX_PENDING_JOBS:
+            backlog = len(inflight) - STYLIZE_WORKERS + 1
+            raise Rejected('server busy, try again later', 503,
+                           job_seconds[0] * backlog / STYLIZE_WORKERS)
+        jobs[job_id] = {'id': job_id, 'status': 'done' if done else 'queued', 'src': target,
+                        'model': model, 'epoch': epoch, 'submitted': time.time(), 'updated': time.time()}
+        finished = [k for k, job in jobs.items() if job['status'] in ('done', 'failed')]
+        for k in finished[:max(0, len(finished) - MAX_JOB_RECORDS)]:
+            del jobs[k]
+        message = json.dumps({'src': target, 'job': job_id, 'ip_addr': client})
+        if not done:
+            inflight[target] = job_id
+            job_queue.put((job_id, target, data, model, epoch, message))
+    if done:
+        broadcast(message)
+    return job_id, not done
+
+
+def stylize_worker():
+    """drains job_queue, broadcasting each finished image"""
+    while True:
+        job_id, target, data, model, epoch, message = job_queue.get()
+        update_job(job_id, status='running')
+        start = time.time()
+        try:
+            if save_normalized_image(target, data, model, epoch):
+                job_seconds[0] = 0.8 * job_seconds[0] + 0.2 * (time.time() - start)
+                update_job(job_id, status='done')
+                gallery.add(target)
+                broadcast(message)  # Notify subscribers of completion
+            else:
+                update_job(job_id, status='failed', error='could not read image')
+        except Exception as e:
+            update_job(job_id, status='failed', error='{0}'.format(e))
+        finally:
+            with jobs_lock:
+                inflight.pop(target, None)
+            job_queue.task_done()
+
+
+def start_workers(n=STYLIZE_WORKERS):
+    for _ in range(n):
+        threading.Thread(target=stylize_worker, daemon=True).start()
+
+
+def event_stream(client, last_event_id=None):
+    try:
+        for chunk in hub.stream(last_event_id, keep_alive=KEEP_ALIVE_DELAY):
+            yield chunk
     finally:
-        if not force_disconnect:
-            print('{0} disconnected from stream'.format(client))
+        print('{0} disconnected from stream'.format(client))
+
+
+def parse_event_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
 @app.route('/post', methods=['POST'])
 def post():
-    sha1sum = sha1(flask.request.data).hexdigest()
-    target = os.path.join(DATA_DIR, '{0}.jpg'.format(sha1sum))
-    message = json.dumps({'src': target,
-                          'ip_addr': safe_addr(flask.request.access_route[0])})
+    # reject before the body is read: oversized uploads, clients over their rate
+    if flask.request.content_length is not None and flask.request.content_length > MAX_UPLOAD_BYTES:
+        return 'upload larger than {0} bytes'.format(MAX_UPLOAD_BYTES), 413
     try:
-        if save_normalized_image(target, flask.request.data):
-            broadcast(message)  # Notify subscribers of completion
-    except Exception as e:  # Output errors
-        return '{0}'.format(e)
-    return 'success'
+        rate_limiter.take(flask.request.access_route[0])
+        model, epoch = parse_style(flask.request.args)
+        validate_upload(flask.request.data)
+        sha1sum = sha1(flask.request.data).hexdigest()
+        target = os.path.join(DATA_DIR, '{0}-{1}-{2}.{3}'.format(sha1sum, model, epoch,
+                                                                OUTPUT_EXTENSIONS[OUTPUT_FORMAT]))
+        job_id, pending = submit_job(target, flask.request.data, model, epoch,
+                                     safe_addr(flask.request.access_route[0]))
+    except ValueError as e:
+        return '{0}'.format(e), 400
+    except Rejected as e:
+        return '{0}'.format(e), e.status, {'Retry-After': str(e.retry_after)}
+    return flask.jsonify(job=job_id, src=target,
+                         status=flask.url_for('job_status', job_id=job_id)), 202 if pending else 200
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return 'upload larger than {0} bytes'.format(MAX_UPLOAD_BYTES), 413
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    with jobs_lock:
+        job = dict(jobs[job_id]) if job_id in jobs else None
+    if job is None:
+        return flask.jsonify(error='unknown job'), 404
+    job['queued'] = job_queue.qsize()
+    return flask.jsonify(job)
 
 
 @app.route('/stream')
 def stream():
-    return flask.Response(event_stream(flask.request.access_route[0]),
-                          mimetype='text/event-stream')
+    last_event_id = parse_event_id(flask.request.headers.get('Last-Event-ID'))
+    return flask.Response(event_stream(flask.request.access_route[0], last_event_id),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/styles')
+def styles():
+    """available styles and epochs, and the generators currently loaded"""
+    return flask.jsonify(models=cgan.CATALOG.models(), default=MODEL,
+                         loaded=cgan.cyclegan_worker.pool_status())
 
 
 @app.route('/')
 def home():
-    # Code adapted from: http://stackoverflow.com/questions/168409/
-    image_infos = []
-    for filename in os.listdir(DATA_DIR):
-        filepath = os.path.join(DATA_DIR, filename)
-        file_stat = os.stat(filepath)
-        if S_ISREG(file_stat[ST_MODE]):
-            image_infos.append((file_stat[ST_CTIME], filepath))
-
-    images = []
-    for i, (_, path) in enumerate(sorted(image_infos, reverse=True)):
-        if i >= MAX_IMAGES:
-            os.unlink(path)
-            continue
-        images.append('<div id="images"><img alt="User uploaded image" src="{0}" /></div>'
-.format(path))
-    print(image_infos)
     return """
 <!doctype html>
 <title>GAN Style Transfer Demo</title>
@@ -224,6 +494,7 @@ h2 {
 dynamically view new images.</noscript>
 <fieldset>
   <p id="status">Select an image</p>
+  <select id="style">%s</select>
   <div id="progressbar"></div>
   <input id="file" type="file" />
   <div id="drop">or drop image here</div>
@@ -263,15 +534,19 @@ dynamically view new images.</noscript>
       });
       xhr.onreadystatechange = function(e1) {
           if (this.readyState == 4)  {
-              if (this.status == 200)
-                  var text = 'upload complete: ' + this.responseText;
+              if (this.status == 202)
+                  var text = 'upload complete, stylizing (job ' + $.parseJSON(this.responseText)['job'] + ')';
+              else if (this.status == 200)
+                  var text = 'upload complete, already stylized';
               else
-                  var text = 'upload failed: code ' + this.status;
+                  var text = 'upload failed: code ' + this.status + ' ' + this.responseText;
+              if (this.getResponseHeader('Retry-After'))
+                  text += ', try again in ' + this.getResponseHeader('Retry-After') + 's';
               status.html(text + '<br/>Select an image');
               progressbar.progressbar('destroy');
           }
       };
-      xhr.open('POST', '/post', true);
+      xhr.open('POST', '/post?model=' + encodeURIComponent($('#style').val()), true);
       xhr.send(to_upload);
   };
   function handle_hover(e) {
@@ -301,9 +576,21 @@ dynamically view new images.</noscript>
     var s = document.getElementsByTagName('script')[0]; s.parentNode.insertBefore(ga, s);
   })();
 </script>
-""" % (MAX_IMAGES, '\n'.join(images))
+""" % (MAX_IMAGES, style_options.html(), gallery.html())
+
+
+gallery.start()
+style_options.start()
+start_workers()
 
 
 if __name__ == '__main__':
     app.debug = True
+    # with the reloader the watching parent runs this too, only the serving child should warm
+    serving = not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    if cgan.PERSISTENT_WORKER and serving:
+        try:  # load the default generator before the first upload
+            cgan.cyclegan_worker.warm(cgan.create_options(MODEL, EPOCH))
+        except cgan.cyclegan_worker.WorkerCrashed as e:
+            print('Could not warm {0}: {1}'.format(MODEL, e))
 app.run('0.0.0.0', threaded=True)
@@ -0,0 +1,161 @@
+import time
+import numpy as np
+from keras.utils import Sequence
+
+
+def rgb_to_hsv(rgb):
+    """vectorized rgb -> hsv for float arrays in [0, 1], channels last"""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(-1)
+    minc = rgb.min(-1)
+    delta = maxc - minc
+    safe = np.where(delta > 0, delta, 1)
+    h = np.where(maxc == r, (g - b) / safe,
+                 np.where(maxc == g, 2.0 + (b - r) / safe, 4.0 + (r - g) / safe))
+    h = np.where(delta > 0, (h / 6.0) % 1.0, 0)
+    s = np.where(maxc > 0, delta / np.where(maxc > 0, maxc, 1), 0)
+    return np.stack([h, s, maxc], -1)
+
+
+def hsv_to_rgb(hsv):
+    """vectorized hsv -> rgb for float arrays in [0, 1], channels last"""
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    i = np.floor(h * 6.0)
+    f = h * 6.0 - i
+    p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+    i = (i.astype('int32') % 6)[..., None]
+    choices = [np.stack(c, -1) for c in [(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)]]
+    return np.choose(i, choices)
+
+
+class BatchAugmenter:
+    """
+    augments whole NHWC batches with vectorized numpy ops
+    shifts and crops are integer index gathers with nearest-edge fill,
+    so the output keeps the input shape and dtype
+    """
+
+    def __init__(self, horizontal_flip=False, vertical_flip=False, width_shift=0, height_shift=0,
+                 crop_scale=1.0, hsv_jitter=(0.0, 0.0, 0.0), hsv_input=False, seed=0):
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+        self.width_shift = width_shift      # max shift in pixels
+        self.height_shift = height_shift    # max shift in pixels
+        self.crop_scale = crop_scale        # min side of the random crop as a fraction of the image
+        self.hsv_jitter = hsv_jitter        # max (hue, saturation, value) offsets
+        self.hsv_input = hsv_input          # batches are already HSV (cfg.hsv)
+        self.seed = seed
+        self.nflows = 0
+
+    @property
+    def enabled(self):
+        return bool(self.horizontal_flip or self.vertical_flip or self.width_shift or self.height_shift
+                    or self.crop_scale < 1.0 or any(self.hsv_jitter))
+
+    def gather_indices(self, n, size, shift, rng):
+        """per-image source indices along one axis for a random crop + shift"""
+        crop = np.full(n, size)
+        if self.crop_scale < 1.0:
+            crop = rng.randint(int(np.ceil(self.crop_scale * size)), size + 1, n)
+        offset = rng.randint(0, size - crop + 1)
+        idx = offset[:, None] + (np.arange(size)[None, :] * crop[:, None]) // size
+        if shift:
+            idx -= rng.randint(-shift, shift + 1, n)[:, None]
+        return np.clip(idx, 0, size - 1)
+
+    def jitter_hsv(self, batch, rng):
+        scale = 255.0 if batch.dtype == np.uint8 else 1.0
+        x = batch.astype('float32') / scale
+        if not self.hsv_input:
+            x = rgb_to_hsv(x)
+        offsets = np.stack([rng.uniform(-j, j, len(batch)) for j in self.hsv_jitter], -1)
+        x += offsets[:, None, None, :].astype('float32')
+        x[..., 0] %= 1.0
+        np.clip(x[..., 1:], 0, 1, out=x[..., 1:])
+        if not self.hsv_input:
+            x = hsv_to_rgb(x)
+        x *= scale
+        return (np.rint(x) if batch.dtype == np.uint8 else x).astype(batch.dtype)
+
+    def augment(self, batch, rng):
+        n, h, w = batch.shape[:3]
+        if self.crop_scale < 1.0 or self.width_shift or self.height_shift or \
+                self.horizontal_flip or self.vertical_flip:
+            rows = self.gather_indices(n, h, self.height_shift, rng)
+            cols = self.gather_indices(n, w, self.width_shift, rng)
+            if self.vertical_flip:
+                flip = rng.rand(n) < 0.5
+                rows[flip] = rows[flip, ::-1]
+            if self.horizontal_flip:
+                flip = rng.rand(n) < 0.5
+                cols[flip] = cols[flip, ::-1]
+            batch = batch[np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+        if any(self.hsv_jitter):
+            batch = self.jitter_hsv(batch, rng)
+        return batch
+
+    def flow(self, x, y, batch_size=32, shuffle=True, seed=None):
+        """drop-in for ImageDataGenerator.flow, each call draws a new shuffle"""
+        if seed is None:
+            seed = self.seed + self.nflows
+        self.nflows += 1
+        return AugmentedSequence(x, y, self, batch_size, shuffle, seed)
+
+
+class AugmentedSequence(Sequence):
+    """
+    keras Sequence over (x, y); batch i is augmented with an RNG seeded by
+    (seed, epoch, i), so results do not depend on which loader worker runs it
+    """
+
+    def __init__(self, x, y, augmenter, batch_size=32, shuffle=True, seed=0):
+        self.x, self.y = x, y
+        self.augmenter = augmenter
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.order = self.permutation()
+
+    def permutation(self):
+        if not self.shuffle:
+            return np.arange(len(self.x))
+        return np.random.RandomState([self.seed, self.epoch]).permutation(len(self.x))
+
+    def __len__(self):
+        return int(np.ceil(len(self.x) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        ind = np.sort(self.order[idx * self.batch_size:(idx + 1) * self.batch_size])
+        rng = np.random.RandomState([self.seed, self.epoch, idx])
+        return self.augmenter.augment(self.x[ind], rng), self.y[ind]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self.permutation()
+
+
+def benchmark(n=4096, imsize=64, batch_size=32, nbatches=100):
+    """
+    images/sec of keras ImageDataGenerator.flow vs BatchAugmenter for flips + shifts
+    """
+    from keras.preprocessing.image import ImageDataGenerator
+    x = np.random.random((n, imsize, imsize, 3)).astype('float32')
+    y = np.zeros((n, 1), dtype='float32')
+    shift = 0.1
+    datagen = ImageDataGenerator(width_shift_range=shift, height_shift_range=shift,
+                                 horizontal_flip=True, vertical_flip=True)
+    augmenter = BatchAugmenter(horizontal_flip=True, vertical_flip=True,
+                               width_shift=int(shift * imsize), height_shift=int(shift * imsize))
+    flows = [('ImageDataGenerator', datagen.flow(x, y, batch_size=batch_size, shuffle=True)),
+             ('BatchAugmenter', augmenter.flow(x, y, batch_size=batch_size, shuffle=True))]
+    for name, flow in flows:
+        start = time.perf_counter()
+        for i in range(nbatches):
+            flow[i % len(flow)]
+        elapsed = time.perf_counter() - start
+        print("%-20s %8.0f images/sec" % (name, nbatches * batch_size / elapsed))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,101 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import multiprocessing
+from cnn_utils import CPU_PROFILES, apply_cpu_profile, build_model, session_config
+
+
+def time_steps(step, nsteps, warmup):
+    """runs step() warmup + nsteps times, returns the timed latencies in seconds"""
+    for _ in range(warmup):
+        step()
+    latencies = []
+    for _ in range(nsteps):
+        start = time.perf_counter()
+        step()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def summarize(latencies, batch_size):
+    """samples/sec and step latency percentiles (ms) for a list of step latencies"""
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {'samples_per_sec': batch_size * len(latencies) / latencies.sum(),
+            'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+
+
+def run_profile(profile_name, combos, imsize, nclasses, train_steps, predict_steps, warmup):
+    """
+    benchmarks every (vgglayers, batch_size) combination under one CPU profile
+    runs in its own process so the TF/OpenMP thread pools start fresh
+    """
+    profile = apply_cpu_profile(profile_name)
+    import tensorflow as tf
+    import keras.backend as K
+    import keras.backend.tensorflow_backend as ktf
+    from keras.optimizers import Adam
+    from keras.utils import np_utils
+
+    results = []
+    for vgglayers, batch_size in combos:
+        K.clear_session()
+        ktf.set_session(tf.Session(config=session_config(
+            intra_op_threads=profile['intra_op_threads'], inter_op_threads=profile['inter_op_threads'])))
+        model, _ = build_model(nclasses, imsize + (3,), vgglayers, fclayers=2, fclayersize=128)
+        model.compile(loss='categorical_crossentropy', optimizer=Adam(lr=.00001), metrics=['accuracy'])
+
+        x = np.random.random((batch_size,) + imsize + (3,)).astype('float32')
+        y = np_utils.to_categorical(np.random.randint(0, nclasses, batch_size), nclasses)
+        for phase, step, nsteps in [('train', lambda: model.train_on_batch(x, y), train_steps),
+                                    ('predict', lambda: model.predict_on_batch(x), predict_steps)]:
+            row = {'profile': profile_name, 'vgglayers': vgglayers, 'batch_size': batch_size, 'phase': phase}
+            row.update(summarize(time_steps(step, nsteps, warmup), batch_size))
+            print("%(profile)s vgg%(vgglayers)d bs=%(batch_size)d %(phase)s: "
+                  "%(samples_per_sec)0.1f samples/sec, p50=%(p50_ms)0.1fms p99=%(p99_ms)0.1fms" % row)
+            results.append(row)
+    return results
+
+
+def benchmark(profiles, vgglayers, batch_sizes, imsize=(64, 64), nclasses=5,
+              train_steps=20, predict_steps=20, warmup=3):
+    """
+    runs a fixed number of train and predict steps on random data for each
+    profile x vgglayers x batch_size combination, returns a results DataFrame
+    """
+    combos = [(v, b) for v in vgglayers for b in batch_sizes]
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for profile_name in profiles:
+        with ctx.Pool(1) as pool:
+            results += pool.apply(run_profile, (profile_name, combos, imsize, nclasses,
+                                                train_steps, predict_steps, warmup))
+    return pd.DataFrame(results)
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU throughput benchmark for the train_cnn model")
+    parser.add_argument('--profiles', default=','.join(sorted(CPU_PROFILES)),
+                        help="comma separated names from cnn_utils.CPU_PROFILES")
+    parser.add_argument('--vgglayers', type=int_list, default=[1, 2, 3])
+    parser.add_argument('--batch-sizes', type=int_list, default=[16, 32, 64])
+    parser.add_argument('--imsize', type=int, default=64)
+    parser.add_argument('--nclasses', type=int, default=5)
+    parser.add_argument('--train-steps', type=int, default=20)
+    parser.add_argument('--predict-steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', default='benchmark_cnn.csv')
+    args = parser.parse_args()
+
+    stats = benchmark(args.profiles.split(','), args.vgglayers, args.batch_sizes,
+                      imsize=(args.imsize,) * 2, nclasses=args.nclasses, train_steps=args.train_steps,
+                      predict_steps=args.predict_steps, warmup=args.warmup)
+    stats.to_csv(args.out, index=False)
+    print(stats.to_string(index=False))
+    best = stats.loc[stats.groupby(['phase', 'vgglayers', 'batch_size'])['samples_per_sec'].idxmax()]
+    print("\nFastest profile per configuration:")
+    print(best[['phase', 'vgglayers', 'batch_size', 'profile', 'samples_per_sec']].to_string(index=False))
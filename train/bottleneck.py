@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+
+
+def split_model(model, flatten_name='flatten'):
+    """
+    splits the classifier at the flatten layer
+    returns (conv_model, head_model); head_model shares its Dense layers with model,
+    so training the head trains the full model
+    """
+    from keras.models import Model
+    from keras.layers import Input
+    names = [l.name for l in model.layers]
+    flatten = model.get_layer(flatten_name)
+    conv_model = Model(model.input, flatten.output, name='conv_stack')
+
+    head_input = Input(shape=flatten.output_shape[1:])
+    x = head_input
+    for layer in model.layers[names.index(flatten_name) + 1:]:
+        x = layer(x)
+    return conv_model, Model(head_input, x, name='fc_head')
+
+
+def check_frozen(conv_model):
+    """raises ValueError if any layer of the conv stack would still be trained"""
+    trainable = [l.name for l in conv_model.layers if l.trainable and l.weights]
+    if trainable:
+        raise ValueError("Bottleneck training needs a fully frozen conv stack, trainable: %s" % trainable)
+
+
+def array_digest(x):
+    """content hash of an array, used as the dataset version"""
+    digest = hashlib.sha1(str((x.shape, x.dtype.str)).encode('utf8'))
+    digest.update(np.ascontiguousarray(x).data)
+    return digest.hexdigest()
+
+
+def conv_digest(conv_model):
+    """hash of the conv stack architecture and weights"""
+    digest = hashlib.sha1(json.dumps(conv_model.get_config(), sort_keys=True, default=str).encode('utf8'))
+    for w in conv_model.get_weights():
+        digest.update(np.ascontiguousarray(w).data)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    conv features per dataset split, keyed by the conv stack and the data; a new
+    entry for a split replaces the older ones
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, conv_model, x, name):
+        key = hashlib.sha1((conv_digest(conv_model) + array_digest(x)).encode('utf8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '%s-%s.npy' % (name, key))
+
+    def features(self, conv_model, x, name, batch_size=256):
+        """
+        returns the flattened conv features of x as a read-only memmap,
+        computing them in batches on a cache miss
+        """
+        path = self.path(conv_model, x, name)
+        if not os.path.exists(path):
+            shape = (len(x),) + tuple(conv_model.output_shape[1:])
+            tmp_path = path + '.tmp'
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=shape)
+            for i in tqdm(range(0, len(x), batch_size), desc='Caching %s features' % name, mininterval=3):
+                out[i:i + batch_size] = conv_model.predict_on_batch(x[i:i + batch_size])
+            out.flush()
+            del out
+            os.replace(tmp_path, path)
+            self.remove_stale(name, keep=path)
+        else:
+            print("**** Using cached %s features: %s ****" % (name, path))
+        return np.load(path, mmap_mode='r')
+
+    def remove_stale(self, name, keep):
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            if f.startswith(name + '-') and path != keep:
+                os.remove(path)
@@ -0,0 +1,90 @@
+import json
+import time
+import numpy as np
+from keras import backend as K
+
+
+class TrainingBudget:
+    """
+    early stopping, reduce-on-plateau and hard limits for the train_cnn loop
+    call update() once per epoch, it returns True when training should stop
+    """
+
+    def __init__(self, model, optimizer, monitor='val_acc', patience=500, min_delta=0.0,
+                 lr_patience=100, lr_factor=0.5, min_lr=1e-7, max_seconds=None, max_samples=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.monitor = monitor
+        self.sign = 1 if 'acc' in monitor else -1   # maximize accuracies, minimize losses
+        self.patience = patience
+        self.min_delta = min_delta
+        self.lr_patience = lr_patience
+        self.lr_factor = lr_factor
+        self.min_lr = min_lr
+        self.max_seconds = max_seconds
+        self.max_samples = max_samples
+
+        self.start = time.time()
+        self.samples = 0
+        self.epochs = 0
+        self.best = -np.inf
+        self.best_epoch = None
+        self.best_weights = None
+        self.wait = 0
+        self.lr_wait = 0
+        self.lr_reductions = []
+        self.stop_reason = None
+
+    def lr(self):
+        return float(K.get_value(self.optimizer.lr))
+
+    def update(self, epoch, history, nsamples):
+        """records one epoch of fit history, returns True to stop training"""
+        self.epochs = epoch + 1
+        self.samples += nsamples
+        value = self.sign * history[self.monitor][-1]
+        if value > self.best + self.min_delta:
+            self.best, self.best_epoch = value, epoch
+            self.best_weights = self.model.get_weights()
+            self.wait = self.lr_wait = 0
+        else:
+            self.wait += 1
+            self.lr_wait += 1
+
+        if self.lr_patience and self.lr_wait >= self.lr_patience and self.lr() > self.min_lr:
+            new_lr = max(self.lr() * self.lr_factor, self.min_lr)
+            print("**** %s plateaued for %d epochs, reducing learning rate to %g ****" % (
+                self.monitor, self.lr_wait, new_lr))
+            K.set_value(self.optimizer.lr, new_lr)
+            self.lr_reductions.append((epoch, new_lr))
+            self.lr_wait = 0
+
+        if self.patience and self.wait >= self.patience:
+            self.stop_reason = 'no %s improvement for %d epochs' % (self.monitor, self.wait)
+        elif self.max_seconds is not None and time.time() - self.start >= self.max_seconds:
+            self.stop_reason = 'wall-clock limit of %ds reached' % self.max_seconds
+        elif self.max_samples is not None and self.samples >= self.max_samples:
+            self.stop_reason = 'sample limit of %d reached' % self.max_samples
+        if self.stop_reason:
+            print("**** Stopping: %s ****" % self.stop_reason)
+        return self.stop_reason is not None
+
+    def finish(self, summary_path):
+        """restores the best weights and writes a json summary of the run"""
+        if self.stop_reason is None:
+            self.stop_reason = 'epoch limit reached'
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+        summary = {'stop_reason': self.stop_reason,
+                   'epochs': self.epochs,
+                   'samples': self.samples,
+                   'seconds': time.time() - self.start,
+                   'monitor': self.monitor,
+                   'best': None if self.best_epoch is None else self.sign * float(self.best),
+                   'best_epoch': self.best_epoch,
+                   'final_lr': self.lr(),
+                   'lr_reductions': self.lr_reductions}
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print("Training summary:", summary)
+        return summary
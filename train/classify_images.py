@@ -0,0 +1,143 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import multiprocessing
+from tqdm import tqdm
+from cnn_utils import parse_modelarch, build_model, load_image, scale_batch, session_config
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_images(source, shard=None):
+    """
+    returns the image paths in a directory tree or in a dataset csv (Path column)
+    shard is an optional (index, count) tuple selecting every count-th image
+    """
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            for f in files:
+                if f[0] != '.' and os.path.splitext(f)[1].lower() in IMG_EXTENSIONS:
+                    paths.append(os.path.join(root, f))
+    else:
+        paths = list(pd.read_csv(source)['Path'])
+    paths = sorted(paths)
+    if shard is not None:
+        index, count = shard
+        paths = paths[index::count]
+    return paths
+
+
+def _decode(args):
+    """decodes one image in a worker, returns None for corrupt files"""
+    path, imsize, hsv = args
+    try:
+        return path, load_image(path, imsize, hsv)
+    except (OSError, ValueError):
+        return path, None
+
+
+def iter_batches(paths, imsize, hsv, batch_size, workers):
+    """
+    yields (paths, scaled images) batches, decoding in parallel with ordered output
+    decode workers are spawned rather than forked, since the caller already runs a TF session
+    """
+    jobs = ((p, imsize, hsv) for p in paths)
+    pool = multiprocessing.get_context('spawn').Pool(workers) if workers > 0 else None
+    decoded = pool.imap(_decode, jobs, chunksize=16) if pool else map(_decode, jobs)
+    batch_paths, batch = [], []
+    try:
+        for path, im in decoded:
+            if im is None:
+                print("Warning: corrupt file %s" % path)
+                continue
+            batch_paths.append(path)
+            batch.append(im)
+            if len(batch) == batch_size:
+                yield batch_paths, scale_batch(batch, hsv)
+                batch_paths, batch = [], []
+        if batch:
+            yield batch_paths, scale_batch(batch, hsv)
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def classify(model_path, source, out_path, classes, imsize=(64, 64), batch_size=256,
+             decode_workers=4, intra_op_threads=0, inter_op_threads=0, batchnorm=False, shard=None):
+    """
+    writes per-image class probabilities for every image in source to out_path
+    out_path ending in .parquet is written columnar, anything else as csv
+    returns the throughput in images/sec
+    """
+    import tensorflow as tf
+    import keras.backend.tensorflow_backend as ktf
+    ktf.set_session(tf.Session(config=session_config(
+        intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)))
+
+    arch = parse_modelarch(model_path)
+    model, _ = build_model(len(classes), tuple(imsize) + (3,), arch['vgglayers'],
+                           arch['fclayers'], arch['fclayersize'], batchnorm=batchnorm)
+    model.load_weights(model_path)
+
+    paths = list_images(source, shard)
+    columnar = out_path.endswith('.parquet')
+    frames, header = [], True
+    if not columnar and os.path.exists(out_path):
+        os.remove(out_path)
+
+    nimages, start = 0, time.time()
+    progress = tqdm(total=len(paths), desc='Classifying', mininterval=3)
+    for batch_paths, xbatch in iter_batches(paths, tuple(imsize), arch['hsv'], batch_size, decode_workers):
+        probs = model.predict(xbatch, batch_size=batch_size)
+        frame = pd.DataFrame(probs, columns=classes)
+        frame.insert(0, 'Predicted', [classes[i] for i in np.argmax(probs, axis=1)])
+        frame.insert(0, 'Path', batch_paths)
+        if columnar:
+            frames.append(frame)
+        else:
+            frame.to_csv(out_path, mode='a', header=header, index=False)
+            header = False
+        nimages += len(batch_paths)
+        progress.update(len(batch_paths))
+    progress.close()
+    if columnar:
+        pd.concat(frames).to_parquet(out_path, index=False)
+
+    elapsed = time.time() - start
+    rate = nimages / elapsed if elapsed > 0 else 0.0
+    print("Classified %d images in %0.1fs (%0.1f images/sec)" % (nimages, elapsed, rate))
+    return rate
+
+
+def parse_shard(value):
+    """parses an 'index/count' shard argument"""
+    index, count = (int(v) for v in value.split('/'))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be in [0, count)")
+    return index, count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch classification with a trained train_cnn model")
+    parser.add_argument('model', help="model-<arch>.h5 weights written by train_cnn")
+    parser.add_argument('source', help="image directory or dataset.csv")
+    parser.add_argument('out', help="output .csv or .parquet file")
+    parser.add_argument('--classes-from', required=True,
+                        help="training folder whose subdirectories are the class names")
+    parser.add_argument('--imsize', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--decode-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--batchnorm', action='store_true', help="model was trained with cfg.batchnorm")
+    parser.add_argument('--shard', type=parse_shard, default=None, help="index/count, e.g. 0/4")
+    args = parser.parse_args()
+
+    classes = sorted([x for x in os.listdir(args.classes_from) if x[0] != '.'])
+    classify(args.model, args.source, args.out, classes, imsize=(args.imsize,) * 2,
+             batch_size=args.batch_size, decode_workers=args.decode_workers,
+             intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads,
+             batchnorm=args.batchnorm, shard=args.shard)
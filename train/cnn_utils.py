@@ -0,0 +1,119 @@
+import os
+import re
+import numpy as np
+
+# (filters, convolutions) for each of the 5 VGG16 blocks
+VGG_BLOCKS = [(64, 2), (128, 2), (256, 3), (512, 3), (512, 3)]
+MODELARCH_PATTERN = re.compile(r'model-vgg(\d+)-fcl(\d+)-fcs(\d+)-(hsv|rgb)-(.+)\.h5$')
+
+# Named CPU execution profiles (0 threads = let TF decide)
+#   intra_op_threads: threads used inside a single op (conv, matmul)
+#   inter_op_threads: independent ops run concurrently
+#   omp_threads: OpenMP/MKL pool size for MKL builds of TF, must be set before the first op
+#   loader_workers: threads preparing augmented batches ahead of training
+NCORES = os.cpu_count() or 1
+CPU_PROFILES = {
+    'default': {'intra_op_threads': 0, 'inter_op_threads': 0, 'omp_threads': 0, 'loader_workers': 1},
+    'throughput': {'intra_op_threads': NCORES, 'inter_op_threads': 2,
+                   'omp_threads': NCORES, 'loader_workers': 4},
+    'latency': {'intra_op_threads': NCORES, 'inter_op_threads': 1,
+                'omp_threads': NCORES, 'loader_workers': 1},
+    'shared': {'intra_op_threads': max(1, NCORES // 2), 'inter_op_threads': 1,
+               'omp_threads': max(1, NCORES // 2), 'loader_workers': 2},
+    'single': {'intra_op_threads': 1, 'inter_op_threads': 1, 'omp_threads': 1, 'loader_workers': 1},
+}
+
+
+def parse_modelarch(model_path):
+    """
+    recovers the architecture settings encoded in a model-<arch>.h5 filename
+    written by train_cnn
+    """
+    match = MODELARCH_PATTERN.search(os.path.basename(model_path))
+    if match is None:
+        raise ValueError("Cannot parse model architecture from " + model_path)
+    vgglayers, fclayers, fclayersize, colorspace, hostname = match.groups()
+    return {'vgglayers': int(vgglayers),
+            'fclayers': int(fclayers),
+            'fclayersize': int(fclayersize),
+            'hsv': colorspace == 'hsv',
+            'hostname': hostname}
+
+
+def build_model(nclasses, tsize, vgglayers, fclayers, fclayersize,
+                batchnorm=False, l1=0.0, l2=0.0):
+    """
+    builds the (uncompiled) VGG style classifier used by train_cnn
+    returns the model and its input tensor
+    """
+    from keras.models import Model
+    from keras.regularizers import l1_l2
+    from keras.layers import Flatten, Dense, Input, Convolution2D, MaxPooling2D, BatchNormalization
+
+    img_input = Input(shape=tsize)
+    x = img_input
+    for block, (filters, nconv) in enumerate(VGG_BLOCKS[:vgglayers], 1):
+        for conv in range(1, nconv + 1):
+            x = Convolution2D(filters, (3, 3), activation='relu',
+                              padding='same', name='block%d_conv%d' % (block, conv))(x)
+        x = MaxPooling2D((2, 2), strides=(2, 2), name='block%d_pool' % block)(x)
+        if batchnorm:
+            x = BatchNormalization()(x)
+
+    x = Flatten(name='flatten')(x)
+    for i in range(fclayers):
+        x = Dense(fclayersize, activation='relu',
+                  kernel_regularizer=l1_l2(l1, l2))(x)
+    x = Dense(nclasses, activation='softmax', name='predictions')(x)
+    return Model(img_input, x, name='vgg16'), img_input
+
+
+def load_image(path, imsize, hsv=False):
+    """
+    reads an image and applies the resize/colorspace steps of train_cnn.load_data
+    raises OSError for corrupt files
+    """
+    import scipy.misc
+    import skimage.color
+    im = scipy.misc.imread(path, mode='RGB')
+    im = scipy.misc.imresize(im, imsize, interp='bicubic')
+    if hsv:
+        im = skimage.color.rgb2hsv(im)
+    return im
+
+
+def scale_batch(xdata, hsv=False):
+    """
+    maps a batch from load_image to the [0, 1] range seen during training
+    load_data rescales by the dataset min/max, which is 0-255 for RGB
+    and 0-1 for HSV on any realistic training set
+    """
+    xdata = np.asarray(xdata, dtype='float32')
+    if not hsv:
+        xdata /= 255.0
+    return xdata
+
+
+def apply_cpu_profile(name):
+    """
+    exports the OpenMP settings of a named CPU profile and returns the profile
+    """
+    if name not in CPU_PROFILES:
+        raise ValueError("Unknown CPU profile %s, choose from %s" % (name, sorted(CPU_PROFILES)))
+    profile = CPU_PROFILES[name]
+    if profile['omp_threads'] > 0:
+        os.environ['OMP_NUM_THREADS'] = str(profile['omp_threads'])
+        os.environ.setdefault('KMP_BLOCKTIME', '0')
+    return profile
+
+
+def session_config(gpu_fraction=1.0, intra_op_threads=0, inter_op_threads=0):
+    """
+    tensorflow session config; 0 threads lets TF pick the pool sizes
+    """
+    import tensorflow as tf
+    gpu_options = tf.GPUOptions(
+        per_process_gpu_memory_fraction=gpu_fraction, allow_growth=True)
+    return tf.ConfigProto(gpu_options=gpu_options,
+                          intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
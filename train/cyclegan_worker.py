@@ -0,0 +1,392 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import shutil
+import psutil
+import tempfile
+import threading
+import subprocess
+import collections
+from skimage.io import imread, imsave
+import raw_frames
+
+WORKER_CMD = ['th', 'stylize_worker.lua']
+REPLY_PREFIX = '@@'
+MAX_RESTARTS = 2
+# seconds to wait for a reply before the worker is treated as hung and restarted
+REQUEST_TIMEOUT = float(os.environ.get('CYCLEGAN_WORKER_TIMEOUT', 120))
+START_TIMEOUT = 300     # loading a generator can take longer than one request
+# worker processes per generator, so parallel jobs on one model don't queue on one process
+MAX_REPLICAS = int(os.environ.get('CYCLEGAN_WORKER_REPLICAS', 2))
+# resident memory all worker processes may use before idle generators are evicted, LRU first
+MEMORY_BUDGET = int(os.environ.get('CYCLEGAN_WORKER_MEMORY_MB', 4096)) * 2 ** 20
+# scratch space for image exchange, tmpfs when available
+WORKSPACE_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class StylizationWorker:
+    """
+    client for a long-lived stylization process that keeps one (model, epoch)
+    generator loaded, see stylize_worker.lua for the line protocol
+    cmd can point at any program speaking the protocol, e.g. the stand-in
+    `python cyclegan_worker.py --stand-in`
+    images go over raw_frames files when the worker advertises `raw` and
+    transport isn't 'png', PNG otherwise
+    """
+
+    def __init__(self, opts, cmd=None, transport=None):
+        self.opts = opts
+        self.cmd = cmd or WORKER_CMD
+        self.transport = transport
+        self.process = None
+        self.capabilities = set()
+        self.workdir = tempfile.mkdtemp(prefix='stylize-worker-', dir=WORKSPACE_ROOT)
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.pending = 0    # requests waiting on or holding self.lock, guarded by _workers_lock
+        self.retired = False    # dropped from the pool after a failed start, closed by the last release
+
+    def start(self):
+        env = os.environ.copy()
+        env.update({k: str(v).strip('"') for k, v in self.opts.items()})
+        try:
+            self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            env=env, bufsize=1, universal_newlines=True)
+        except OSError as e:
+            raise WorkerCrashed("Cannot start stylization worker %s: %s" % (self.cmd, e))
+        # stdout is read on a thread so replies can be waited for with a deadline
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_lines, args=(self.process.stdout, self.replies),
+                         daemon=True).start()
+        reply = self.read_reply(START_TIMEOUT)
+        if reply[0] != 'READY':
+            raise WorkerCrashed("Unexpected worker greeting: %s" % ' '.join(reply))
+        self.capabilities = set(reply[1:])
+
+    @staticmethod
+    def read_lines(stdout, replies):
+        for line in stdout:
+            replies.put(line)
+        replies.put(None)
+
+    def read_reply(self, timeout=None):
+        """
+        returns the next protocol reply as a list of words, skipping any other output
+        raises WorkerCrashed if the worker exits or stays silent for timeout
+        (default REQUEST_TIMEOUT) seconds
+        """
+        timeout = timeout or REQUEST_TIMEOUT
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self.replies.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                raise WorkerCrashed("Stylization worker gave no reply within %d seconds" % timeout)
+            if line is None:
+                raise WorkerCrashed("Stylization worker exited with code %s" % self.process.poll())
+            if line.startswith(REPLY_PREFIX):
+                return line[len(REPLY_PREFIX):].split()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def memory(self):
+        """resident bytes of the worker process, 0 when it isn't running"""
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss if self.alive() else 0
+        except psutil.Error:
+            return 0
+
+    def request(self, input_path, output_path):
+        if not self.alive():
+            self.start()
+        self.process.stdin.write('%s\t%s\n' % (input_path, output_path))
+        self.process.stdin.flush()
+        reply = self.read_reply()
+        if reply[0] != 'OK':
+            raise RuntimeError("Stylization failed: %s" % ' '.join(reply[1:]))
+
+    def use_raw(self, img):
+        return self.transport != 'png' and 'raw' in self.capabilities and raw_frames.supported(img)
+
+    def stylize(self, img):
+        """stylizes one image, restarting the worker if it died"""
+        with self.lock:
+            for attempt in range(MAX_RESTARTS + 1):
+                try:
+                    if not self.alive():
+                        self.start()
+                    raw = self.use_raw(img)
+                    ext = '.raw' if raw else '.png'
+                    input_path = os.path.join(self.workdir, 'input' + ext)
+                    output_path = os.path.join(self.workdir, 'output' + ext)
+                    if raw:
+                        raw_frames.write_raw(input_path, img)
+                    else:
+                        imsave(input_path, img)
+                    self.request(input_path, output_path)
+                    break
+                except (WorkerCrashed, BrokenPipeError) as e:
+                    self.kill()
+                    if attempt == MAX_RESTARTS:
+                        raise
+                    self.restarts += 1
+                    print("Restarting stylization worker after crash:", e)
+            return raw_frames.read_raw(output_path) if raw else imread(output_path)
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        with self.lock:
+            if self.alive():
+                try:
+                    self.process.stdin.write('QUIT\n')
+                    self.process.stdin.flush()
+                    self.process.wait(timeout=10)
+                except (BrokenPipeError, subprocess.TimeoutExpired):
+                    pass
+            self.kill()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+_workers = collections.OrderedDict()   # worker_key -> replicas, least recently used first
+_workers_lock = threading.Lock()
+
+
+def worker_key(opts):
+    return (opts['name'], str(opts['which_epoch']), opts['which_direction'],
+            opts['loadSize'], opts['fineSize'])
+
+
+def pool_memory():
+    """resident bytes of all workers, caller holds _workers_lock"""
+    return sum(w.memory() for replicas in _workers.values() for w in replicas)
+
+
+def evict(reserve=0, keep=None):
+    """
+    unregisters least recently used idle generators until the pool plus reserve
+    bytes fits MEMORY_BUDGET, busy generators and keep are never evicted
+    caller holds _workers_lock and closes the returned workers after releasing it
+    """
+    used, victims = pool_memory(), []
+    for key in list(_workers):
+        if used + reserve <= MEMORY_BUDGET:
+            break
+        replicas = _workers[key]
+        if key == keep or any(w.pending for w in replicas):
+            continue
+        for worker in replicas:
+            used -= worker.memory()
+            victims.append(worker)
+        del _workers[key]
+        print("Evicted generator %s epoch %s" % key[:2])
+    return victims
+
+
+def get_worker(opts, cmd=None):
+    """
+    returns the least busy worker for the generator described by opts, starting
+    a new replica while all existing ones are busy and fewer than MAX_REPLICAS run
+    starting a worker first evicts idle generators to stay within MEMORY_BUDGET
+    the registry lock only covers bookkeeping: evicted workers are closed and the
+    new replica is started after releasing it, so other generators aren't blocked
+    the caller must release() the worker when done
+    """
+    key = worker_key(opts)
+    victims, new = [], False
+    with _workers_lock:
+        replicas = _workers.setdefault(key, [])
+        _workers.move_to_end(key)
+        worker = min(replicas, key=lambda w: w.pending) if replicas else None
+        if worker is None or (worker.pending > 0 and len(replicas) < MAX_REPLICAS):
+            running = [w.memory() for r in _workers.values() for w in r if w.alive()]
+            victims = evict(reserve=sum(running) / len(running) if running else 0, keep=key)
+            worker, new = StylizationWorker(opts, cmd), True
+            replicas.append(worker)     # reserve the slot, requests routed here wait on worker.lock
+        worker.pending += 1
+    for victim in victims:
+        victim.close()
+    if new:
+        try:
+            with worker.lock:
+                if not worker.alive():
+                    worker.start()
+        except WorkerCrashed:
+            with _workers_lock:
+                if worker in replicas:
+                    replicas.remove(worker)
+                if not replicas and _workers.get(key) is replicas:
+                    del _workers[key]
+                worker.retired = True
+            release(worker)
+            raise
+    return worker
+
+
+def release(worker):
+    """returns a worker from get_worker, closing it if it was dropped from the pool meanwhile"""
+    with _workers_lock:
+        worker.pending -= 1
+        close = worker.retired and worker.pending == 0
+    if close:
+        worker.close()
+
+
+def test(img, opts):
+    """same contract as test_cyclegan.test, served by a persistent worker"""
+    worker = get_worker(opts)
+    try:
+        return worker.stylize(img)
+    finally:
+        release(worker)
+
+
+def warm(opts):
+    """loads the generator for opts ahead of the first request"""
+    release(get_worker(opts))
+
+
+def pool_status():
+    """loaded generators, most recently used last"""
+    with _workers_lock:
+        return [{'model': key[0], 'epoch': key[1], 'replicas': len(replicas),
+                 'pending': sum(w.pending for w in replicas),
+                 'memory_mb': sum(w.memory() for w in replicas) / 2 ** 20}
+                for key, replicas in _workers.items()]
+
+
+def epoch_order(epoch):
+    return (0, int(epoch)) if epoch.isdigit() else (1, epoch)
+
+
+class CheckpointCatalog:
+    """
+    cached index of generator checkpoints (<epoch>_net_G*.t7) under checkpoints_dir
+    a model folder is only listed again when its mtime changes
+    """
+
+    def __init__(self, checkpoints_dir='./checkpoints'):
+        self.checkpoints_dir = checkpoints_dir
+        self.entries = {}   # model folder -> (mtime, epochs)
+        self.listing = None     # (checkpoints_dir mtime, model folder names)
+        self.lock = threading.Lock()
+
+    def model_dir(self, model):
+        return model if os.path.isdir(model) else os.path.join(self.checkpoints_dir, model)
+
+    def epochs(self, model):
+        """available epochs of model (a name or a folder path), numeric epochs in order"""
+        path = self.model_dir(model)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != mtime:
+                epochs = {f.split('_')[0] for f in os.listdir(path)
+                          if f.endswith('.t7') and '_net_G' in f}
+                entry = self.entries[path] = (mtime, sorted(epochs - {'latest'}, key=epoch_order))
+            return list(entry[1])
+
+    def names(self):
+        """model folder names, listed again only when checkpoints_dir's mtime changes"""
+        try:
+            mtime = os.stat(self.checkpoints_dir).st_mtime
+        except OSError:
+            return []
+        with self.lock:
+            if self.listing is None or self.listing[0] != mtime:
+                self.listing = (mtime, sorted(name for name in os.listdir(self.checkpoints_dir)
+                                              if os.path.isdir(os.path.join(self.checkpoints_dir, name))))
+            return list(self.listing[1])
+
+    def models(self):
+        """model name -> available epochs, for every model with at least one generator"""
+        models = {name: self.epochs(name) for name in self.names()}
+        return {name: epochs for name, epochs in models.items() if epochs}
+
+    def has(self, model, epoch):
+        return str(epoch) in self.epochs(model)
+
+
+def close_all():
+    with _workers_lock:
+        for replicas in _workers.values():
+            for worker in replicas:
+                worker.close()
+        _workers.clear()
+
+
+atexit.register(close_all)
+
+
+def stand_in_worker():
+    """
+    protocol stand-in for testing without Torch: returns each input image unchanged
+    """
+    print(REPLY_PREFIX + 'READY png raw', flush=True)
+    for line in sys.stdin:
+        line = line.rstrip('\n')
+        if line == 'QUIT':
+            break
+        try:
+            input_path, output_path = line.split('\t')
+            shutil.copyfile(input_path, output_path)
+            print(REPLY_PREFIX + 'OK', flush=True)
+        except Exception as e:
+            print(REPLY_PREFIX + 'ERR ' + str(e).replace('\n', ' '), flush=True)
+
+
+def benchmark(size=512, n=20):
+    """
+    per-image transport cost of PNG vs raw frames: the file codec alone,
+    then a full round trip through the stand-in worker
+    """
+    import time
+    import numpy as np
+    img = np.random.RandomState(0).randint(0, 256, (size, size, 3)).astype(np.uint8)
+    workdir = tempfile.mkdtemp(prefix='stylize-bench-', dir=WORKSPACE_ROOT)
+    codecs = {
+        'png': lambda path: (imsave(path, img), imread(path)),
+        'raw': lambda path: (raw_frames.write_raw(path, img), raw_frames.read_raw(path)),
+    }
+    try:
+        for transport in ['png', 'raw']:
+            path = os.path.join(workdir, 'frame.' + transport)
+            start = time.time()
+            for _ in range(n):
+                codecs[transport](path)
+            codec_ms = (time.time() - start) / n * 1000
+
+            worker = StylizationWorker({}, cmd=[sys.executable, os.path.abspath(__file__), '--stand-in'],
+                                       transport=transport)
+            worker.stylize(img)     # start the process outside the timing
+            start = time.time()
+            for _ in range(n):
+                out = worker.stylize(img)
+            round_trip_ms = (time.time() - start) / n * 1000
+            worker.close()
+            assert (out == img).all()
+            print("%s: %dx%d codec (write+read) %0.2f ms/image, worker round trip %0.2f ms/image" % (
+                transport, size, size, codec_ms, round_trip_ms))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if '--stand-in' in sys.argv:
+        stand_in_worker()
+    elif '--benchmark' in sys.argv:
+        benchmark()
@@ -0,0 +1,117 @@
+import threading
+import collections
+
+REPLAY_SIZE = 256           # recent events kept for Last-Event-ID catch-up
+SUBSCRIBER_BUFFER = 64      # undelivered events per subscriber before its overflow policy applies
+KEEP_ALIVE_DELAY = 25
+
+
+class Subscriber:
+    """
+    one stream's bounded buffer; on overflow it either drops its oldest events
+    ('drop_oldest') or is closed ('disconnect') so the client reconnects and
+    catches up from the replay ring with Last-Event-ID
+    """
+
+    def __init__(self, size=SUBSCRIBER_BUFFER, overflow='disconnect'):
+        self.buffer = collections.deque()
+        self.size = size
+        self.overflow = overflow
+        self.closed = False
+        self.dropped = 0
+        self.ready = threading.Condition(threading.Lock())
+
+    def push(self, event):
+        with self.ready:
+            if self.closed:
+                return
+            if len(self.buffer) >= self.size:
+                if self.overflow == 'disconnect':
+                    self.closed = True
+                    self.ready.notify()
+                    return
+                self.buffer.popleft()
+                self.dropped += 1
+            self.buffer.append(event)
+            self.ready.notify()
+
+    def pop(self, timeout):
+        """returns the buffered events, an empty list after timeout, None once closed"""
+        with self.ready:
+            if not self.buffer and not self.closed:
+                self.ready.wait(timeout)
+            if self.closed and not self.buffer:
+                return None
+            events = list(self.buffer)
+            self.buffer.clear()
+            return events
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class EventHub:
+    """
+    publish/subscribe for server-sent events: events get increasing ids, the
+    last REPLAY_SIZE are kept for reconnecting clients, and publishing costs
+    one buffer append per subscriber
+    """
+
+    def __init__(self, replay_size=REPLAY_SIZE, buffer_size=SUBSCRIBER_BUFFER, overflow='disconnect'):
+        self.replay = collections.deque(maxlen=replay_size)
+        self.buffer_size = buffer_size
+        self.overflow = overflow
+        self.subscribers = set()
+        self.last_id = 0
+        self.lock = threading.Lock()            # guards subscribers and the replay ring
+        self.publish_lock = threading.Lock()    # one publish at a time, so fan-out follows id order
+
+    def publish(self, data):
+        with self.publish_lock:
+            with self.lock:
+                self.last_id += 1
+                event = (self.last_id, data)
+                self.replay.append(event)
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.push(event)
+        return event[0]
+
+    def subscribe(self, last_event_id=None):
+        """
+        registers a subscriber; with last_event_id, events after it that are still
+        in the replay ring are delivered first
+        """
+        subscriber = Subscriber(max(self.buffer_size, len(self.replay)), self.overflow)
+        with self.lock:
+            if last_event_id is not None:
+                for event in self.replay:
+                    if event[0] > last_event_id:
+                        subscriber.push(event)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def stream(self, last_event_id=None, keep_alive=KEEP_ALIVE_DELAY):
+        """yields server-sent event text, with a comment line every keep_alive idle seconds"""
+        subscriber = self.subscribe(last_event_id)
+        try:
+            while True:
+                events = subscriber.pop(keep_alive)
+                if events is None:
+                    return
+                if not events:
+                    yield ': keep-alive\n\n'
+                for event_id, data in events:
+                    yield 'id: {0}\ndata: {1}\n\n'.format(event_id, data)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def __len__(self):
+        return len(self.subscribers)
@@ -0,0 +1,192 @@
+import os
+import mmap
+import time
+import tempfile
+import socket
+import random
+import argparse
+import numpy as np
+import pandas as pd
+import multiprocessing
+from cnn_utils import NCORES, build_model, load_image, scale_batch, session_config
+
+IMG_EXTENSION = '.jpg'
+BARRIER_TIMEOUT = 600   # seconds to wait for the slowest worker before giving up
+# the weight exchange block is a file mapped by every worker, on tmpfs when available
+SHM_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def list_samples(folder, samples_per_class, seed=0):
+    """
+    returns (path, class index) pairs and the class names of a train/test folder,
+    sampled the same way in every worker so the shards do not overlap
+    """
+    classes = sorted([x for x in os.listdir(folder) if x[0] != '.'])
+    rng = random.Random(seed)
+    samples = []
+    for clsid, cls in enumerate(classes):
+        files = sorted(f for f in os.listdir(os.path.join(folder, cls))
+                       if f[0] != '.' and IMG_EXTENSION in f.lower())
+        files = rng.sample(files, min(len(files), samples_per_class))
+        samples += [(os.path.join(folder, cls, f), clsid) for f in files]
+    rng.shuffle(samples)
+    return samples, classes
+
+
+def load_samples(samples, nclasses, imsize, hsv):
+    from keras.utils import np_utils
+    xdata, ydata = [], []
+    for path, clsid in samples:
+        try:
+            xdata.append(load_image(path, imsize, hsv))
+            ydata.append(clsid)
+        except OSError:
+            print("Warning: corrupt file %s" % path)
+    return scale_batch(xdata, hsv), np_utils.to_categorical(ydata, nclasses)
+
+
+class WeightAverager:
+    """
+    synchronous weight averaging over a memory-mapped block of (nworkers + 1) rows:
+    each rank publishes its weights in its own row, averages a 1/n column slice into
+    the last row (reduce-scatter), then every rank reads the averaged row back
+    """
+
+    def __init__(self, path, rank, nworkers, nparams, barrier, create=False):
+        self.rank, self.nworkers, self.barrier = rank, nworkers, barrier
+        size = (nworkers + 1) * nparams * 4
+        with open(path, 'w+b' if create else 'r+b') as f:
+            if create:
+                f.truncate(size)
+            self.mmap = mmap.mmap(f.fileno(), size)
+        self.buf = np.frombuffer(self.mmap, dtype='float32').reshape(nworkers + 1, nparams)
+        bounds = np.linspace(0, nparams, nworkers + 1).astype(int)
+        self.cols = slice(bounds[rank], bounds[rank + 1])
+
+    def average(self, model):
+        weights = model.get_weights()
+        self.buf[self.rank] = np.concatenate([w.ravel() for w in weights])
+        self.barrier.wait(BARRIER_TIMEOUT)
+        self.buf[-1, self.cols] = self.buf[:-1, self.cols].mean(axis=0)
+        self.barrier.wait(BARRIER_TIMEOUT)
+        flat, offset, averaged = self.buf[-1], 0, []
+        for w in weights:
+            averaged.append(flat[offset:offset + w.size].reshape(w.shape))
+            offset += w.size
+        model.set_weights(averaged)
+
+    def close(self):
+        del self.buf
+        self.mmap.close()
+
+
+def worker(rank, args, barrier, shm_path):
+    """trains one data shard; rank 0 also validates, checkpoints and writes stats"""
+    threads = max(1, NCORES // args.workers)
+    import tensorflow as tf
+    import keras.backend.tensorflow_backend as ktf
+    from keras.optimizers import Adam
+    ktf.set_session(tf.Session(config=session_config(intra_op_threads=threads, inter_op_threads=1)))
+
+    imsize = (args.imsize,) * 2
+    train_samples, classes = list_samples(os.path.join(args.basepath, 'train'), args.samples_per_class)
+    x_train, y_train = load_samples(train_samples[rank::args.workers], len(classes), imsize, args.hsv)
+    model, _ = build_model(len(classes), imsize + (3,), args.vgglayers, args.fclayers, args.fclayersize)
+    model.compile(loss='categorical_crossentropy', optimizer=Adam(lr=args.lr), metrics=['accuracy'])
+    nparams = sum(w.size for w in model.get_weights())
+
+    # rank 0 creates the shared block and starts everyone from its initial weights
+    if rank == 0:
+        averager = WeightAverager(shm_path, rank, args.workers, nparams, barrier, create=True)
+        averager.buf[-1] = np.concatenate([w.ravel() for w in model.get_weights()])
+        test_samples, _ = list_samples(os.path.join(args.basepath, 'test'), args.test_samples_per_class)
+        x_test, y_test = load_samples(test_samples, len(classes), imsize, args.hsv)
+        barrier.wait(BARRIER_TIMEOUT)
+    else:
+        barrier.wait(BARRIER_TIMEOUT)
+        averager = WeightAverager(shm_path, rank, args.workers, nparams, barrier)
+    offset, initial = 0, []
+    for w in model.get_weights():
+        initial.append(averager.buf[-1, offset:offset + w.size].reshape(w.shape).copy())
+        offset += w.size
+    model.set_weights(initial)
+    barrier.wait(BARRIER_TIMEOUT)
+
+    modelarch = 'vgg%d-fcl%d-fcs%d-%s-%s' % (args.vgglayers, args.fclayers, args.fclayersize,
+                                             'hsv' if args.hsv else 'rgb', socket.gethostname())
+    modelid = os.path.join(args.out, 'model-%s.h5' % modelarch)
+    stats = []
+    start = time.time()
+    for step in range(args.steps):
+        ind = np.random.randint(0, len(x_train), args.batch_size)
+        loss, acc = model.train_on_batch(x_train[ind], y_train[ind])
+        if (step + 1) % args.sync_every == 0 or step == args.steps - 1:
+            averager.average(model)
+        if rank == 0 and (step % args.eval_every == 0 or step == args.steps - 1):
+            val_loss, val_acc = model.evaluate(x_test, y_test, verbose=0)
+            samples_per_sec = (step + 1) * args.batch_size * args.workers / (time.time() - start)
+            print("step %d: loss=%0.4f val_loss=%0.4f val_acc=%0.2f%% (%0.1f samples/sec)" % (
+                step, loss, val_loss, 100 * val_acc, samples_per_sec))
+            stats.append((step, loss, val_loss, val_acc, acc, samples_per_sec))
+            pd.DataFrame(stats, columns=('Step', 'Train loss', 'Test loss', 'Accuracy', 'Train accuracy',
+                                         'Samples/sec')).to_csv(
+                os.path.join(args.out, 'trainstats-%s.csv' % modelarch), index=False)
+        if rank == 0 and (step % args.checkpoint_every == 0 or step == args.steps - 1):
+            model.save_weights(modelid, overwrite=True)
+
+    barrier.wait(BARRIER_TIMEOUT)
+    averager.close()
+
+
+def train_parallel(args):
+    """
+    starts args.workers local training processes and waits for them; if one
+    fails the barrier is aborted and the rest are stopped, and the shared
+    block is removed however the workers exit
+    """
+    os.makedirs(args.out, exist_ok=True)
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(args.workers)
+    shm_path = os.path.join(SHM_ROOT, 'deeppainting-%d' % os.getpid())
+    procs = [ctx.Process(target=worker, args=(rank, args, barrier, shm_path)) for rank in range(args.workers)]
+    try:
+        for p in procs:
+            p.start()
+        while any(p.is_alive() for p in procs):
+            if any(p.exitcode not in (None, 0) for p in procs):
+                barrier.abort()
+                for p in procs:
+                    p.terminate()
+            time.sleep(1)
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        if os.path.exists(shm_path):
+            os.remove(shm_path)
+    failed = [rank for rank, p in enumerate(procs) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError("Training workers %s failed" % failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of the train_cnn model")
+    parser.add_argument('basepath', help="dataset folder with train/ and test/ subfolders")
+    parser.add_argument('out', help="output folder for checkpoints and stats")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--sync-every', type=int, default=1, help="average weights every K steps")
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=32, help="per worker")
+    parser.add_argument('--eval-every', type=int, default=10)
+    parser.add_argument('--checkpoint-every', type=int, default=50)
+    parser.add_argument('--samples-per-class', type=int, default=2000)
+    parser.add_argument('--test-samples-per-class', type=int, default=500)
+    parser.add_argument('--imsize', type=int, default=64)
+    parser.add_argument('--hsv', action='store_true')
+    parser.add_argument('--vgglayers', type=int, default=2)
+    parser.add_argument('--fclayers', type=int, default=2)
+    parser.add_argument('--fclayersize', type=int, default=128)
+    parser.add_argument('--lr', type=float, default=.00001)
+    train_parallel(parser.parse_args())
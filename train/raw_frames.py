@@ -0,0 +1,46 @@
+import struct
+import numpy as np
+
+# raw uint8 frame files exchanged with stylize_worker.lua instead of PNGs:
+# a 20 byte little-endian header (magic, height, width, channels, dtype)
+# followed by the HxWxC pixel bytes, read back through a memory map
+MAGIC = b'CGRW'
+DTYPE = b'|u1 '     # numpy dtype string padded to 4 bytes, only uint8 for now
+HEADER = struct.Struct('<4sIII4s')
+
+
+def supported(img):
+    """whether img can be sent as a raw frame, otherwise callers fall back to PNG"""
+    img = np.asarray(img)
+    return img.dtype == np.uint8 and (img.ndim == 2 or (img.ndim == 3 and img.shape[2] in (1, 3, 4)))
+
+
+def as_rgb(img):
+    """HxWx3 contiguous uint8 view of a grey, RGB or RGBA image, like image.load(path, 3)"""
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = img[:, :, None]
+    if img.shape[2] == 1:
+        img = np.repeat(img, 3, axis=2)
+    return np.ascontiguousarray(img[:, :, :3])
+
+
+def write_raw(path, img):
+    img = as_rgb(img)
+    h, w, c = img.shape
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, h, w, c, DTYPE))
+        f.write(img.data)
+
+
+def read_raw(path):
+    """returns a copy of the frame, the file is reused for the next request"""
+    with open(path, 'rb') as f:
+        magic, h, w, c, dtype = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or dtype != DTYPE:
+        raise ValueError("%s is not a raw uint8 frame" % path)
+    frame = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER.size, shape=(h, w, c))
+    try:
+        return np.array(frame)
+    finally:
+        del frame
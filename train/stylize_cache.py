@@ -0,0 +1,159 @@
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+
+CACHE_DIR = '.stylize_cache'
+MEMORY_BUDGET = 256 * 2 ** 20   # bytes of stylized images kept in memory
+DISK_BUDGET = 4 * 2 ** 30       # bytes of .npy files kept in CACHE_DIR
+KEY_OPTIONS = ['name', 'which_epoch', 'loadSize', 'fineSize', 'which_direction']
+
+
+def cache_key(img, opts):
+    """hash of the image content and the options that affect the stylized result"""
+    img = np.ascontiguousarray(img)
+    digest = hashlib.sha1(str((img.shape, img.dtype.str)).encode('utf8'))
+    digest.update(img.data)
+    digest.update('|'.join(str(opts[k]) for k in KEY_OPTIONS).encode('utf8'))
+    return digest.hexdigest()
+
+
+class StylizationCache:
+    """
+    two-tier LRU cache of stylized images: an in-memory tier and a .npy disk
+    tier, each evicting least recently used entries beyond its byte budget
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_budget=MEMORY_BUDGET, disk_budget=DISK_BUDGET):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.writing = set()    # keys being written to disk
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        if disk_budget:
+            self.scan_disk()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def scan_disk(self):
+        """rebuilds the disk LRU index from file mtimes"""
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.npy'):
+                    st = os.stat(os.path.join(root, f))
+                    entries.append((st.st_mtime, f[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+    def get(self, key):
+        """returns the cached image or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.memory[key]
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+        if on_disk:
+            try:
+                img = np.load(self.path(key))
+                os.utime(self.path(key))
+            except (OSError, ValueError):
+                with self.lock:
+                    self.disk_bytes -= self.disk.pop(key, 0)
+            else:
+                with self.lock:
+                    self.stats['disk_hits'] += 1
+                    self.put_memory(key, img)
+                return img
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, img):
+        img = np.asarray(img)
+        img.setflags(write=False)
+        with self.lock:
+            self.put_memory(key, img)
+            write = self.disk_budget and key not in self.disk and key not in self.writing
+            if write:
+                self.writing.add(key)
+        if not write:
+            return
+        path = self.path(key)
+        tmp_path = path + '.%d.tmp' % threading.get_ident()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError:
+            # a full or read-only disk costs the disk tier, not the stylized image
+            with self.lock:
+                self.stats['disk_errors'] += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        finally:
+            with self.lock:
+                self.writing.discard(key)
+        with self.lock:
+            self.disk_bytes += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+            evicted = self.evict_disk()
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def put_memory(self, key, img):
+        """adds to the memory tier, caller holds the lock"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        if img.nbytes > self.memory_budget:
+            return
+        self.memory[key] = img
+        self.memory_bytes += img.nbytes
+        while self.memory_bytes > self.memory_budget:
+            _, old = self.memory.popitem(last=False)
+            self.memory_bytes -= old.nbytes
+            self.stats['memory_evictions'] += 1
+
+    def evict_disk(self):
+        """drops LRU disk entries beyond the budget, caller holds the lock"""
+        evicted = []
+        while self.disk_bytes > self.disk_budget and len(self.disk) > 1:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            evicted.append(key)
+            self.stats['disk_evictions'] += 1
+        return evicted
+
+    def get_or_compute(self, img, opts, stylize):
+        key = cache_key(img, opts)
+        result = self.get(key)
+        if result is None:
+            result = stylize(img, opts)
+            self.put(key, result)
+        return result
+
+    def summary(self):
+        with self.lock:
+            lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+            return dict(self.stats, lookups=lookups,
+                        hit_rate=(lookups - self.stats['misses']) / lookups if lookups else 0.0,
+                        memory_entries=len(self.memory), memory_bytes=self.memory_bytes,
+                        disk_entries=len(self.disk), disk_bytes=self.disk_bytes)
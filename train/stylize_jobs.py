@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from skimage.io import imread, imsave
+
+BATCH_SIZE = 16     # images per stylization call within a (model, epoch) group
+
+
+class Job:
+    """
+    one (input, model, epoch) stylization, written to one or more output paths
+    a job with a task runs on its own as task(input_path, output_path, model, epoch)
+    for each output, e.g. a video; the task must write its output atomically
+    """
+
+    def __init__(self, input_path, model, epoch, task=None):
+        self.input_path = input_path
+        self.model = model
+        self.epoch = str(epoch)
+        self.task = task
+        self.outputs = []
+        self.status = 'pending'
+        self.error = None
+        self.seconds = None
+
+    @property
+    def id(self):
+        return '%s|%s|%s' % (self.model, self.epoch, self.input_path)
+
+    def done(self, previous_status=None):
+        """
+        outputs are written atomically, so existing ones are complete; jobs a previous
+        run recorded as failed or left running are redone anyway
+        """
+        return previous_status not in ('failed', 'running') and all(os.path.exists(p) for p in self.outputs)
+
+    def to_dict(self):
+        return {'input': self.input_path, 'model': self.model, 'epoch': self.epoch,
+                'outputs': self.outputs, 'status': self.status, 'error': self.error,
+                'seconds': self.seconds}
+
+
+class StylizationScheduler:
+    """
+    expands files x models x epochs into a deduplicated job graph, runs each
+    (model, epoch) group on a worker pool so its generator loads once, skips
+    jobs whose outputs exist and records per-job status in a json manifest
+    stylize_batch(imgs, opts) and make_options(model, epoch) come from test_cyclegan
+    """
+
+    def __init__(self, manifest_path, stylize_batch, make_options, workers=2, batch_size=BATCH_SIZE):
+        self.manifest_path = manifest_path
+        self.stylize_batch = stylize_batch
+        self.make_options = make_options
+        self.workers = workers
+        self.batch_size = batch_size
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def add(self, input_path, model, epoch, output_path, task=None):
+        """adds an output for (input, model, epoch); duplicate requests share one job"""
+        job = Job(os.path.abspath(input_path), model, epoch, task)
+        job = self.jobs.setdefault(job.id, job)
+        if output_path not in job.outputs:
+            job.outputs.append(output_path)
+        return job
+
+    def expand(self, inputs, models, epochs, output_pattern):
+        """
+        adds inputs x models x epochs; epochs is a list or a callable model -> epochs
+        output_pattern is formatted with dir, name, model and epoch
+        """
+        for input_path in inputs:
+            name = os.path.splitext(os.path.basename(input_path))[0]
+            for model in models:
+                for epoch in (epochs(model) if callable(epochs) else epochs):
+                    self.add(input_path, model, epoch, output_pattern.format(
+                        dir=os.path.dirname(input_path), name=name, model=model, epoch=epoch))
+
+    def save_manifest(self):
+        """writes the manifest atomically, caller holds the lock"""
+        self.manifest.update((job_id, job.to_dict()) for job_id, job in self.jobs.items())
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def finish(self, job, status, error=None, seconds=None):
+        with self.lock:
+            job.status, job.error, job.seconds = status, error, seconds
+            self.save_manifest()
+
+    def start(self, jobs):
+        with self.lock:
+            for job in jobs:
+                job.status = 'running'
+            self.save_manifest()
+
+    def write_output(self, path, img):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        root, ext = os.path.splitext(path)
+        tmp_path = '%s.%d.tmp%s' % (root, threading.get_ident(), ext)  # keep the extension for imsave
+        imsave(tmp_path, img)
+        os.replace(tmp_path, path)
+
+    def run_group(self, model, epoch, jobs):
+        opts = self.make_options(model, epoch)
+        for i in range(0, len(jobs), self.batch_size):
+            batch = jobs[i:i + self.batch_size]
+            self.start(batch)
+            start = time.time()
+            try:
+                imgs = [imread(job.input_path) for job in batch]
+                stylized = self.stylize_batch(imgs, opts)
+            except Exception as e:
+                for job in batch:
+                    self.finish(job, 'failed', '%s: %s' % (type(e).__name__, e))
+                print("Failed %s epoch %s: %s" % (model, epoch, e))
+                continue
+            seconds = (time.time() - start) / len(batch)
+            for job, img in zip(batch, stylized):
+                try:
+                    for path in job.outputs:
+                        self.write_output(path, img)
+                    self.finish(job, 'done', seconds=seconds)
+                except Exception as e:
+                    self.finish(job, 'failed', '%s: %s' % (type(e).__name__, e))
+
+    def run_task(self, job):
+        self.start([job])
+        start = time.time()
+        try:
+            for path in job.outputs:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                job.task(job.input_path, path, job.model, job.epoch)
+        except Exception as e:
+            self.finish(job, 'failed', '%s: %s' % (type(e).__name__, e))
+            print("Failed %s: %s" % (job.id, e))
+            return
+        self.finish(job, 'done', seconds=time.time() - start)
+
+    def run(self):
+        """runs all pending jobs, returns the status counts"""
+        groups, tasks = collections.OrderedDict(), []
+        for job in self.jobs.values():
+            if job.done(self.manifest.get(job.id, {}).get('status')):
+                job.status = 'skipped'
+            elif job.task:
+                tasks.append(job)
+            else:
+                groups.setdefault((job.model, job.epoch), []).append(job)
+        with self.lock:
+            self.save_manifest()
+        npending = len(tasks) + sum(len(jobs) for jobs in groups.values())
+        print("Stylizing %d jobs in %d (model, epoch) groups and %d tasks, %d already done" % (
+            npending - len(tasks), len(groups), len(tasks), len(self.jobs) - npending))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.run_task, job) for job in tasks]
+            futures += [executor.submit(self.run_group, model, epoch, jobs)
+                        for (model, epoch), jobs in groups.items()]
+            for future in futures:
+                future.result()
+        return self.report()
+
+    def report(self):
+        counts = collections.Counter(job.status for job in self.jobs.values())
+        print("Jobs:", ', '.join('%s=%d' % kv for kv in sorted(counts.items())))
+        for job in self.jobs.values():
+            if job.status == 'failed':
+                print("  failed:", job.id, job.error)
+        return counts
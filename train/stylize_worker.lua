@@ -0,0 +1,111 @@
+-- Persistent CycleGAN stylization worker used by cyclegan_worker.py
+-- Loads one generator and stylizes the images named on stdin until QUIT.
+--
+-- Protocol (one line per message, replies are prefixed with @@):
+--   worker -> client: @@READY <capabilities>
+--   client -> worker: <input path>\t<output path>
+--   worker -> client: @@OK | @@ERR <message>
+--   client -> worker: QUIT
+--
+-- Capabilities: png (any image.load format), raw (.raw paths hold a raw_frames.py
+-- header followed by HxWx3 uint8 pixels, skipping the PNG codec on both sides)
+--
+-- Usage (run from the CycleGAN base directory):
+--   name=cubism_v1 which_epoch=200 loadSize=512 th stylize_worker.lua
+require 'image'
+require 'nn'
+require 'nngraph'
+
+local opt = {
+  name = os.getenv('name') or 'cubism_v1',
+  which_epoch = os.getenv('which_epoch') or 'latest',
+  which_direction = os.getenv('which_direction') or 'AtoB',
+  checkpoints_dir = os.getenv('checkpoints_dir') or './checkpoints',
+  loadSize = tonumber(os.getenv('loadSize') or 512),
+  gpu = tonumber(os.getenv('gpu') or 1),  -- same default as test.lua, gpu=0 is CPU mode
+}
+
+local function checkpoint_path()
+  local suffixes = {'G', opt.which_direction == 'AtoB' and 'G_A' or 'G_B'}
+  for _, suffix in ipairs(suffixes) do
+    local path = paths.concat(opt.checkpoints_dir, opt.name, opt.which_epoch .. '_net_' .. suffix .. '.t7')
+    if paths.filep(path) then
+      return path
+    end
+  end
+  error('no generator checkpoint for ' .. opt.name .. ' epoch ' .. opt.which_epoch)
+end
+
+local netG = torch.load(checkpoint_path())
+if opt.gpu > 0 then
+  require 'cunn'
+  cutorch.setDevice(opt.gpu)
+  netG = netG:cuda()
+else
+  netG = netG:float()
+end
+
+local RAW_MAGIC = 'CGRW'
+local RAW_DTYPE = '|u1 '
+
+local function is_raw(path)
+  return path:sub(-4) == '.raw'
+end
+
+-- returns a 3xHxW float image in [0, 1]
+local function load_raw(path)
+  local f = torch.DiskFile(path, 'r'):binary():littleEndianEncoding()
+  local magic = f:readChar(4):string()
+  local h, w, c = f:readInt(), f:readInt(), f:readInt()
+  local dtype = f:readChar(4):string()
+  assert(magic == RAW_MAGIC and dtype == RAW_DTYPE and c == 3, 'not a raw uint8 RGB frame: ' .. path)
+  local pixels = torch.ByteTensor(f:readByte(h * w * c), 1, torch.LongStorage{h, w, c})
+  f:close()
+  return pixels:permute(3, 1, 2):float():div(255)
+end
+
+local function save_raw(path, img)
+  local pixels = img:mul(255):add(0.5):floor():byte():permute(2, 3, 1):contiguous()
+  local f = torch.DiskFile(path, 'w'):binary():littleEndianEncoding()
+  f:writeString(RAW_MAGIC)
+  f:writeInt(pixels:size(1))
+  f:writeInt(pixels:size(2))
+  f:writeInt(pixels:size(3))
+  f:writeString(RAW_DTYPE)
+  f:writeByte(pixels:storage())
+  f:close()
+end
+
+local function stylize(input_path, output_path)
+  local img = is_raw(input_path) and load_raw(input_path) or image.load(input_path, 3, 'float')
+  -- scale_width: width becomes loadSize, both sides rounded to a multiple of 4
+  local w = opt.loadSize
+  local h = math.floor(img:size(2) * w / img:size(3) / 4 + 0.5) * 4
+  img = image.scale(img, w, h):mul(2):add(-1)
+  local input = img:view(1, 3, h, w)
+  if opt.gpu > 0 then
+    input = input:cuda()
+  end
+  local output = netG:forward(input)[1]:float():add(1):div(2):clamp(0, 1)
+  if is_raw(output_path) then
+    save_raw(output_path, output)
+  else
+    image.save(output_path, output)
+  end
+end
+
+io.stdout:setvbuf('line')
+print('@@READY png raw')
+for line in io.stdin:lines() do
+  if line == 'QUIT' then
+    break
+  end
+  local input_path, output_path = line:match('^(.-)\t(.-)$')
+  local ok, err = pcall(stylize, input_path, output_path)
+  if ok then
+    print('@@OK')
+  else
+    print('@@ERR ' .. tostring(err):gsub('\n', ' '))
+  end
+  collectgarbage()
+end
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+import collections
+import contextlib
+import numpy as np
+import psutil
+from keras.callbacks import Callback
+
+
+class StackSampler(threading.Thread):
+    """
+    sampling profiler: records the stack of one thread every `interval` seconds
+    """
+
+    def __init__(self, thread_id, interval=0.005, depth=8):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.depth = depth
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append('%s:%d(%s)' % (os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class PhaseCallback(Callback):
+    """
+    splits a single-step fit/fit_generator call into data, fit and validation phases
+    """
+
+    def __init__(self, telemetry):
+        super().__init__()
+        self.telemetry = telemetry
+        self.marks = {}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.marks = {'start': time.perf_counter()}
+
+    def on_batch_begin(self, batch, logs=None):
+        self.marks.setdefault('batch_begin', time.perf_counter())
+
+    def on_batch_end(self, batch, logs=None):
+        self.marks['batch_end'] = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        m = self.marks
+        if 'batch_begin' in m and 'batch_end' in m:
+            self.telemetry.record('data', m['batch_begin'] - m['start'])
+            self.telemetry.record('fit', m['batch_end'] - m['batch_begin'])
+            self.telemetry.record('validation', time.perf_counter() - m['batch_end'])
+
+
+class Telemetry:
+    """
+    per-phase step timers plus RSS, python heap and TF graph growth,
+    written as one json line per step to metrics_path
+    profile_steps=(first, last) enables the stack sampler for that window of steps
+    trace_heap adds tracemalloc overhead to every allocation, so it is off by default
+    """
+
+    def __init__(self, metrics_path, graph_size=None, trace_heap=False, profile_steps=None,
+                 profile_interval=0.005):
+        self.metrics_path = metrics_path
+        self.graph_size = graph_size
+        self.trace_heap = trace_heap
+        self.profile_steps = profile_steps
+        self.profile_interval = profile_interval
+        self.process = psutil.Process(os.getpid())
+        self.phases = collections.OrderedDict()
+        self.history = []
+        self.sampler = None
+        self.samples = collections.Counter()
+        self.step_start = time.perf_counter()
+        if trace_heap and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.metrics_file = open(metrics_path, 'a')
+        self.baseline = self.snapshot()
+
+    def snapshot(self):
+        stats = {'rss_mb': self.process.memory_info().rss / 2 ** 20,
+                 'rss_pct': 100 * self.process.memory_info().rss / psutil.virtual_memory().total}
+        if self.trace_heap:
+            current, peak = tracemalloc.get_traced_memory()
+            stats['heap_mb'], stats['heap_peak_mb'] = current / 2 ** 20, peak / 2 ** 20
+        if self.graph_size is not None:
+            stats['graph_ops'] = self.graph_size()
+        return stats
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def begin_step(self, step):
+        self.phases = collections.OrderedDict()
+        self.step_start = time.perf_counter()
+        if self.profile_steps and step == self.profile_steps[0] and self.sampler is None:
+            print("**** Sampling profiler on for steps %d-%d ****" % tuple(self.profile_steps))
+            self.sampler = StackSampler(threading.get_ident(), self.profile_interval)
+            self.sampler.start()
+
+    def end_step(self, step):
+        if self.sampler is not None and step >= self.profile_steps[1]:
+            self.sampler.stop()
+            self.samples.update(self.sampler.counts)
+            self.sampler = None
+        record = {'step': step, 'time': time.time(),
+                  'step_s': time.perf_counter() - self.step_start,
+                  'phases': dict(self.phases)}
+        record.update(self.snapshot())
+        self.history.append(record)
+        self.metrics_file.write(json.dumps(record) + '\n')
+        self.metrics_file.flush()
+        return record
+
+    def report(self, report_path=None, top_stacks=15):
+        """prints and optionally writes a json summary of the recorded steps"""
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.samples.update(self.sampler.counts)
+            self.sampler = None
+        self.metrics_file.close()
+        if not self.history:
+            return {}
+        names = sorted({n for r in self.history for n in r['phases']})
+        step_total = sum(r['step_s'] for r in self.history)
+        phases = {}
+        for name in names:
+            t = np.array([r['phases'].get(name, 0.0) for r in self.history])
+            phases[name] = {'total_s': float(t.sum()), 'share': float(t.sum() / step_total),
+                            'mean_ms': float(1000 * t.mean()), 'p95_ms': float(1000 * np.percentile(t, 95))}
+        last = self.history[-1]
+        growth = {k: last[k] - self.baseline[k] for k in last
+                  if k in self.baseline and isinstance(last[k], (int, float))}
+        summary = {'steps': len(self.history), 'step_total_s': step_total,
+                   'phases': phases, 'growth': growth,
+                   'top_stacks': self.samples.most_common(top_stacks)}
+
+        print("\nTelemetry over %d steps (%.1fs):" % (len(self.history), step_total))
+        for name, p in sorted(phases.items(), key=lambda item: -item[1]['total_s']):
+            print("  %-12s %5.1f%%  mean=%8.1fms  p95=%8.1fms" % (name, 100 * p['share'], p['mean_ms'], p['p95_ms']))
+        print("  growth since start:", ', '.join('%s=%+.1f' % kv for kv in sorted(growth.items())))
+        for stack, count in summary['top_stacks']:
+            print("  %6d %s" % (count, stack))
+        if report_path:
+            with open(report_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -1,12 +1,34 @@
 import os
+import shlex
 import shutil
+import tempfile
+import threading
 import subprocess
 import time
 import pylab
-import imageio
-import numpy as np
 from tqdm import tqdm
 from skimage.io import imread, imsave
+import cyclegan_worker
+from video_pipeline import VideoPipeline, TemporalReuse
+from stylize_cache import StylizationCache, cache_key
+from stylize_jobs import StylizationScheduler
+from tiling import stylize_tiled, TILE_SIZE, TILE_OVERLAP
+
+# serve test() from a long-lived stylize_worker.lua process per generator
+PERSISTENT_WORKER = os.environ.get('CYCLEGAN_PERSISTENT_WORKER', '1') == '1'
+# stylizations run at once by the job scheduler, tiled stylization and the demo app
+MAX_PARALLEL_JOBS = int(os.environ.get('CYCLEGAN_PARALLEL_JOBS', 2))
+# frames per stylization pass in stylize_video
+VIDEO_CHUNK_SIZE = 64
+# output frame rate of stylize_video, source frames are subsampled to match
+VIDEO_FPS = 30
+
+# content-addressed cache of stylized images used by cached_test
+# created on first use, so importing this module doesn't scan the cache folder
+_result_cache = None
+_result_cache_lock = threading.Lock()
+# available (model, epoch) generators, relisted only when a model folder changes
+CATALOG = cyclegan_worker.CheckpointCatalog('checkpoints')
 
 
 def create_options(model, epoch):
@@ -25,10 +47,10 @@ def create_options(model, epoch):
     return opts_test
 
 
-def create_bash_cmd_test(opts_test):
+def create_bash_cmd_test(opts_test, data_root='.temp_input'):
     """constructs bash command to run CycleGAN with the given settings"""
     cmd = []
-    cmd.append("DATA_ROOT=.temp_input")
+    cmd.append("DATA_ROOT=" + shlex.quote(data_root))
     for opt in opts_test.keys():
         cmd.append(opt + "=" + str(opts_test[opt]))
     cmd += ['th', 'test.lua']
@@ -43,14 +65,19 @@ def check_correct_directory():
         raise ValueError("Script should be run from CycleGAN base directory.")
 
 
-def prep_directories():
-    """ensures clean temporary directories for CycleGAN"""
-    for dir_ in ['.temp_input', '.temp_output']:
-        if os.path.exists(dir_):
-            shutil.rmtree(dir_)
-    for dir_ in ['testA', 'testB']:
-        os.makedirs(os.path.join('.temp_input', dir_))
-    os.makedirs(os.path.join('.temp_output'))
+def prep_workspace():
+    """
+    creates a private workspace for one CycleGAN job (on tmpfs when available)
+    returns (workspace, input dir, output dir); remove the workspace when done
+    """
+    workspace = tempfile.mkdtemp(prefix='cyclegan-job-', dir=cyclegan_worker.WORKSPACE_ROOT)
+    input_dir = os.path.join(workspace, 'input')
+    output_dir = os.path.join(workspace, 'output')
+    os.makedirs(os.path.join(input_dir, 'testA'))
+    # test.lua expects a testB folder but only uses A for AtoB, so alias it instead of copying
+    os.symlink('testA', os.path.join(input_dir, 'testB'))
+    os.makedirs(output_dir)
+    return workspace, input_dir, output_dir
 
 
 def grab_epochs(model):
@@ -58,40 +85,118 @@ def grab_epochs(model):
     given a model name or a folder path,
     returns an array of available epochs
     """
-    if not os.path.isdir(model):
-        model = os.path.join('checkpoints', model)
-    assert os.path.isdir(model), model + " not a valid model"
+    assert os.path.isdir(CATALOG.model_dir(model)), model + " not a valid model"
+    return CATALOG.epochs(model)
 
-    epochs = []
-    for file in os.listdir(model):
-        if file.split('.')[-1] == "t7":
-            epochs.append(file.split('_')[0])
-    epochs = [e for e in epochs if not e == 'latest']
 
-    return list(set(epochs))
+def test(img, opts, tile_size=None):
+    """
+    performs a test inference on img
+    with tile_size, stylizes at full resolution in overlapping tiles (see test_tiled)
+    returns the stylized image
+    """
+    if tile_size:
+        return test_tiled(img, opts, tile_size)
+    if PERSISTENT_WORKER:
+        try:
+            start = time.time()
+            stylized_img = cyclegan_worker.test(img, opts)
+            print("Stylizing complete. Time elapsed:", time.time() - start)
+            return stylized_img
+        except cyclegan_worker.WorkerCrashed as e:
+            print("Persistent worker unavailable, running test.lua:", e)
+    return test_spawn(img, opts)
+
+
+def test_tiled(img, opts, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, workers=MAX_PARALLEL_JOBS):
+    """
+    stylizes img at its own resolution as overlapping tile_size crops, batches of
+    tiles run on up to workers generators in parallel and overlaps are feather-blended
+    generator memory depends on tile_size only, tile_size must be a multiple of 4
+    """
+    opts = dict(opts, loadSize=tile_size, fineSize=tile_size)
+    return stylize_tiled(img, lambda tiles: test_batch(tiles, opts), tile=tile_size,
+                         overlap=overlap, workers=workers)
 
 
-def test(img, opts):
+def result_cache():
+    """the shared StylizationCache used by cached_test"""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = StylizationCache()
+        return _result_cache
+
+
+def cached_test(img, opts, cache=None):
+    """
+    test() behind a cache keyed by image content, model, epoch, sizes and direction
+    returned images are shared between callers and read-only
+    """
+    return (cache or result_cache()).get_or_compute(img, opts, test)
+
+
+def cached_test_batch(imgs, opts, cache=None):
+    """
+    test_batch() behind the result cache, only cache misses are stylized
     """
-    performs a test inference on img, saves to a temp directory
+    cache = cache or result_cache()
+    keys = [cache_key(img, opts) for img in imgs]
+    results = [cache.get(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        for i, result in zip(misses, test_batch([imgs[i] for i in misses], opts)):
+            cache.put(keys[i], result)
+            results[i] = result
+    return results
+
+
+def test_spawn(img, opts):
+    """
+    performs a test inference on img with a fresh test.lua process, saves to a temp directory
     returns the stylized image
     """
-    prep_directories()
-    for dir_ in ['testA', 'testB']:
-        imsave(os.path.join('.temp_input', dir_, 'img.png'), img)
+    return test_batch_spawn([img], opts)[0]
+
+
+def test_batch(imgs, opts):
+    """
+    stylizes a list of images with one generator, returns the results in order
+    """
+    if PERSISTENT_WORKER:
+        try:
+            return [cyclegan_worker.test(img, opts) for img in imgs]
+        except cyclegan_worker.WorkerCrashed as e:
+            print("Persistent worker unavailable, running test.lua:", e)
+    return test_batch_spawn(imgs, opts)
+
+
+def test_batch_spawn(imgs, opts):
+    """
+    stylizes a list of images in a single test.lua run over a private workspace
+    returns the stylized images in input order
+    """
+    workspace, input_dir, output_dir = prep_workspace()
+    try:
+        names = ['img%06d.png' % i for i in range(len(imgs))]
+        for name, img in zip(names, imgs):
+            imsave(os.path.join(input_dir, 'testA', name), img)
 
-    # run the bash command for test phase of CycleGAN
-    cmd = create_bash_cmd_test(opts)
+        # run the bash command for test phase of CycleGAN
+        opts = dict(opts, results_dir=output_dir, how_many='all')
+        cmd = create_bash_cmd_test(opts, data_root=input_dir)
 
-    start = time.time()
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    process.wait()
-    print("Stylizing complete. Time elapsed:", time.time() - start)
+        start = time.time()
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        process.communicate()
+        print("Stylizing complete. %d images, time elapsed:" % len(imgs), time.time() - start)
 
-    # read image back into python
-    path = os.path.join('.temp_output', opts['name'], str(opts['which_epoch']) + "_test", "images", "fake_B", "img.png")
-    stylized_img = imread(path)
-    return stylized_img
+        # read images back into python
+        fake_dir = os.path.join(output_dir, opts['name'], str(opts['which_epoch']) + "_test", "images", "fake_B")
+        stylized_imgs = [imread(os.path.join(fake_dir, name)) for name in names]
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+    return stylized_imgs
 
 
 def stylize_image_all_epochs(img_path, output_dir, model):
@@ -106,28 +211,28 @@ def stylize_image_all_epochs(img_path, output_dir, model):
 
     for epoch in tqdm(available_epochs):
         opts = create_options(model, epoch)
-        stylized_img = test(img, opts)
+        stylized_img = cached_test(img, opts)
         imsave(os.path.join(output_dir, imname + "-" + model + "-epoch-" + str(epoch)) + ".png", stylized_img)
 
 
-def stylize_video(vid_path, out_path, model, epoch):
+def stylize_video(vid_path, out_path, model, epoch, target_fps=VIDEO_FPS,
+                  chunk_size=VIDEO_CHUNK_SIZE, stylize_workers=1, reuse_threshold=None,
+                  keyframe_interval=15):
     """
-    stylizes all frames of a video
+    stylizes all frames of a video, sampled down to target_fps
+    decoding, stylization (chunk_size frames per pass) and encoding run concurrently
+    reuse_threshold enables temporal reuse: frames differing from the last keyframe by
+    less than this mean pixel difference repeat its stylized output
     """
-    video = imageio.get_reader(vid_path, 'mpeg')
-    writer = imageio.get_writer(out_path, fps=30)
     opts = create_options(model, epoch)
-
-    # TODO: don't hardcode 30fps downsampling
-    for i, frame in enumerate(video):
-        if i % 2 == 0:
-            frame = test(np.array(frame), opts)
-            writer.append_data(frame)
-        if i % 10 == 0:
-            print(i, "of", len(video), "frames done.")
-        if i == len(video) - 10:  # TAKE THIS OUT AFTER DONE TESTING
-            break
-    writer.close()
+    reuse = TemporalReuse(reuse_threshold, keyframe_interval) if reuse_threshold else None
+    pipeline = VideoPipeline(lambda frames: test_batch(frames, opts), chunk_size=chunk_size,
+                             stylize_workers=stylize_workers, reuse=reuse)
+    n_frames = pipeline.run(vid_path, out_path, target_fps)
+    print(n_frames, "frames written to", out_path)
+    if reuse:
+        print("Stylized %d keyframes, reused %d frames (%0.1f%% skipped)" % (
+            reuse.keyframes, reuse.reused, 100.0 * reuse.reused / max(1, n_frames)))
 
 
 def repeat_stylization(img_path, out_dir, n_iter, model, epoch):
@@ -157,7 +262,14 @@ def stylize_dir_hacky(input_dir, output_dir):
     epochs_img = [50, 100, 150, 200]
     files = os.listdir(input_dir)
     files = [f for f in files if not f[0] == "."]
-    os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    # jobs are deduplicated and grouped by (model, epoch), finished outputs are skipped on rerun
+    # and failed or interrupted ones (videos included) are redone
+    scheduler = StylizationScheduler(os.path.join(output_dir, "jobs.json"),
+                                     stylize_batch=cached_test_batch,
+                                     make_options=create_options,
+                                     workers=MAX_PARALLEL_JOBS)
+    photos = []
 
     for file in files:
         filename = file.split(".")[0]
@@ -169,38 +281,25 @@ def stylize_dir_hacky(input_dir, output_dir):
         # Videos
         if ".mp4" in file:
             for model in models:
-                print("Applying", model, "to", file, ", saving to")
-                stylize_video(vid_path=os.path.join(input_dir, file),
-                              out_path=os.path.join(output_subdir, file + '-' + model + '.mp4'),
-                              model=model,
-                              epoch=200)
+                out_path = os.path.join(output_subdir, file + '-' + model + '.mp4')
+                scheduler.add(os.path.join(input_dir, file), model, 200, out_path, task=stylize_video)
 
         # Photos
         else:
+            photos.append(file)
 
-            # Images, all epochs, all models
-            if file in ['northwestern.jpeg', 'the_bean.jpeg']:
-                output_subdir_all_epochs = os.path.join(output_dir, file.split(".")[0] + "-all-epochs")
-                os.makedirs(output_subdir_all_epochs, exist_ok=True)
-                for model in models:
-                    print("Applying", model, "to", file, "all epochs", "\nSaving to", output_subdir_all_epochs)
-                    # try:
-                    stylize_image_all_epochs(img_path=os.path.join(input_dir, file),
-                                             output_dir=output_subdir_all_epochs,
-                                             model=model)
-                    # except:
-                    #     pass
-
-            # Images, only certain styles
-            for model in models:
-                for epoch in epochs_img:
-                    try:
-                        img = imread(os.path.join(input_dir, file))
-                        opts = create_options(model, epoch)
-                        stylized_img = test(img, opts)
-                        imsave(os.path.join(output_subdir, filename + "-" + model + "-epoch-" + epoch + ".png"), stylized_img)
-                    except:
-                        pass
+    # Images, all epochs for northwestern / the bean, certain epochs for everything
+    for file in photos:
+        img_path = os.path.join(input_dir, file)
+        filename = file.split(".")[0]
+        if file in ['northwestern.jpeg', 'the_bean.jpeg']:
+            scheduler.expand([img_path], models, grab_epochs,
+                             os.path.join(output_dir, filename + "-all-epochs",
+                                          "{name}-{model}-epoch-{epoch}.png"))
+        scheduler.expand([img_path], models, epochs_img,
+                         os.path.join(output_dir, filename + "-stylized",
+                                      "{name}-{model}-epoch-{epoch}.png"))
+    return scheduler.run()
 
 
 def stylize_image_all_styles(img_path, models):
@@ -0,0 +1,70 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+TILE_SIZE = 512
+TILE_OVERLAP = 64
+
+
+def tile_positions(n, tile, overlap):
+    """start offsets of tiles covering n pixels, the last tile is aligned to the edge"""
+    stride = tile - overlap
+    return list(range(0, n - tile, stride)) + [n - tile]
+
+
+def feather_ramp(tile, overlap, lead, trail):
+    """1d blend weights, ramping up over the overlap on sides shared with a neighbour"""
+    ramp = np.ones(tile, dtype='float32')
+    edge = (np.arange(overlap, dtype='float32') + 0.5) / overlap
+    if lead:
+        ramp[:overlap] = edge
+    if trail:
+        ramp[-overlap:] = edge[::-1]
+    return ramp
+
+
+def stylize_tiled(img, stylize_batch, tile=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=4, workers=2):
+    """
+    stylizes img as overlapping tile x tile crops and feather-blends them back together
+    stylize_batch(tiles) must return same-sized stylized tiles in order
+    tiles are processed one row at a time, so apart from the input and the uint8
+    output, memory is bounded by one row of tiles
+    """
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = np.repeat(img[:, :, None], 3, axis=2)
+    img = img[:, :, :3]
+    h, w = img.shape[:2]
+    # images smaller than a tile are mirrored out to tile size and cropped afterwards
+    if h < tile or w < tile:
+        img = np.pad(img, ((0, max(0, tile - h)), (0, max(0, tile - w)), (0, 0)), mode='symmetric')
+    ph, pw = img.shape[:2]
+    ys, xs = tile_positions(ph, tile, overlap), tile_positions(pw, tile, overlap)
+
+    out = np.empty((ph, pw, 3), dtype=np.uint8)
+    band = np.zeros((tile, pw, 3), dtype='float32')     # weighted sum for rows [y, y + tile)
+    weights = np.zeros((tile, pw, 1), dtype='float32')
+    ramps_x = [feather_ramp(tile, overlap, j > 0, j < len(xs) - 1) for j in range(len(xs))]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, y in enumerate(ys):
+            tiles = [img[y:y + tile, x:x + tile] for x in xs]
+            batches = [executor.submit(stylize_batch, tiles[k:k + batch_size])
+                       for k in range(0, len(tiles), batch_size)]
+            stylized = [t for batch in batches for t in batch.result()]
+
+            ramp_y = feather_ramp(tile, overlap, i > 0, i < len(ys) - 1)
+            for x, ramp_x, t in zip(xs, ramps_x, stylized):
+                t = np.asarray(t)
+                if t.shape[:2] != (tile, tile):
+                    raise ValueError("Stylized tile is %s, expected %dx%d (is loadSize the tile size?)" % (
+                        t.shape[:2], tile, tile))
+                window = (ramp_y[:, None] * ramp_x[None, :])[:, :, None]
+                band[:, x:x + tile] += t[:, :, :3] * window
+                weights[:, x:x + tile] += window
+
+            # rows above the next tile row are final
+            done = (ys[i + 1] if i + 1 < len(ys) else ph) - y
+            out[y:y + done] = np.clip(band[:done] / weights[:done] + 0.5, 0, 255)
+            band[:tile - done], weights[:tile - done] = band[done:].copy(), weights[done:].copy()
+            band[tile - done:], weights[tile - done:] = 0, 0
+    return out[:h, :w]
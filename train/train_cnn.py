@@ -41,6 +41,10 @@ cfg.vgglayers = 2        # Number of VGG layers to create, 0-5 layers
 # Enable transfer learning up to layer n (max 12, -1 = off)
 cfg.xferlearning = -1
 cfg.freeze_conv = False    # Freeze convolutional layers
+# Train only the FC head on cached conv features (needs freeze_conv, all conv
+# layers transferred and augmentation off)
+cfg.bottleneck = False
+cfg.data_seed = 0     # Seed for the per-class sample selection, None = new sample every run
 cfg.fclayersize = 128      # Size of fully connected (FC) layers
 cfg.fclayers = 2        # Number of FC layers
 cfg.fcdropout = 0.4      # Dropout regularization factor for FC layers
@@ -51,10 +55,19 @@ cfg.randomlbls = False
 
 # Optimizer settings
 optimizer = Adam(lr=.00001)
-# Change for early stopping regularization
 cfg.batch_size, cfg.nb_epoch = 32, 10000
+# Training budget (budget.TrainingBudget), None/0 = off
+cfg.monitor = 'val_acc'     # val_acc or val_loss
+cfg.patience = 500          # Early stopping after n epochs without improvement
+cfg.lr_patience = 100       # Reduce learning rate after n epochs without improvement
+cfg.lr_factor = 0.5
+cfg.min_lr = 1e-7
+cfg.max_seconds = None      # Wall-clock limit
+cfg.max_samples = None      # Limit on training samples seen
 cfg.batchnorm = False    # Batch normalization (incompatible with filter viz)
 cfg.saveloadmodel = True     # Save/load models to reduce training time
+# CPU execution profile from cnn_utils.CPU_PROFILES, e.g. CPU_PROFILE=throughput python train_cnn.py
+cfg.cpu_profile = os.environ.get('CPU_PROFILE', 'default')
 cfg.spercls = train_samples_per_class     # Number of samples per class
 
 # Visualization settings
@@ -62,6 +75,10 @@ cfg.hsv = False    # Convert images to Hue/Saturation/Value to be more robust to
 # Decrease for speed, increase for better viz. 0 = off.
 cfg.vizfilt_timeout = 0
 
+# Telemetry settings
+cfg.trace_heap = False     # Track Python heap growth with tracemalloc (slows every allocation)
+cfg.profile_steps = None   # (first, last) epochs to run the sampling profiler, None = off
+
 # Model checkpointing/stats
 os.makedirs(os.path.join(cfg.basepath, cfg.model_subdirectory), exist_ok=True)
 os.makedirs(os.path.join(cfg.basepath, cfg.model_subdirectory, "loss"), exist_ok=True)
@@ -72,33 +89,40 @@ cfg.modelarch = 'vgg%d-fcl%d-fcs%d-%s-%s' % (cfg.vgglayers, cfg.fclayers,
 cfg.modelid = os.path.join(cfg.basepath, cfg.model_subdirectory, 'model-%s.h5' % cfg.modelarch)
 cfg.trainstats = os.path.join(
     cfg.basepath, cfg.model_subdirectory, 'trainstats-%s.csv' % cfg.modelarch)
+cfg.budgetsummary = os.path.join(
+    cfg.basepath, cfg.model_subdirectory, 'budget-%s.json' % cfg.modelarch)
+cfg.metrics = os.path.join(
+    cfg.basepath, cfg.model_subdirectory, 'metrics-%s.jsonl' % cfg.modelarch)
+cfg.telemetryreport = os.path.join(
+    cfg.basepath, cfg.model_subdirectory, 'telemetry-%s.json' % cfg.modelarch)
 
 #%% Image data augmentation
-from keras.preprocessing.image import ImageDataGenerator
-datagen = ImageDataGenerator(
-    featurewise_center=False,               # set input mean to 0 over the dataset
-    samplewise_center=False,                # set each sample mean to 0
-    featurewise_std_normalization=False,    # divide inputs by std of the dataset
-    samplewise_std_normalization=False,     # divide each input by its std
-    zca_whitening=False,                    # apply ZCA whitening
-    # randomly rotate images in the range (degrees, 0 to 180)
-    rotation_range=0,
-    # randomly shift images horizontally (fraction of total width)
-    width_shift_range=0.0,
-    # randomly shift images vertically (fraction of total height)
-    height_shift_range=0.0,
+from augment import BatchAugmenter
+augmenter = BatchAugmenter(
     horizontal_flip=False,                  # randomly flip images
-    vertical_flip=False)                    # randomly flip images
+    vertical_flip=False,                    # randomly flip images
+    # randomly shift images horizontally (pixels)
+    width_shift=0,
+    # randomly shift images vertically (pixels)
+    height_shift=0,
+    # random crop of at least this fraction of each side, resampled to imsize
+    crop_scale=1.0,
+    # max random (hue, saturation, value) offsets
+    hsv_jitter=(0.0, 0.0, 0.0),
+    hsv_input=cfg.hsv)
 #%% ------ CPU/GPU memory fix -------
 import tensorflow as tf
 import keras.backend.tensorflow_backend as ktf
+from cnn_utils import session_config, apply_cpu_profile
 
 
-def get_session(gpu_fraction=gpu_fraction):
-    gpu_options = tf.GPUOptions(
-        per_process_gpu_memory_fraction=gpu_fraction, allow_growth=True)
-    return tf.Session(config=tf.ConfigProto(gpu_options=gpu_options))
-ktf.set_session(get_session())
+def get_session(gpu_fraction=gpu_fraction, profile=None):
+    profile = profile or apply_cpu_profile(cfg.cpu_profile)
+    return tf.Session(config=session_config(gpu_fraction, profile['intra_op_threads'],
+                                            profile['inter_op_threads']))
+cpu_profile = apply_cpu_profile(cfg.cpu_profile)
+print("**** CPU profile: %s %s ****" % (cfg.cpu_profile, cpu_profile))
+ktf.set_session(get_session(profile=cpu_profile))
 
 
 def check_memusage():
@@ -128,6 +152,7 @@ def makedata(basepath):
                 scipy.misc.imsave(pn, scipy.misc.imresize(
                     im, cfg.imsize, interp='bicubic'))
 # makedata(cfg.basepath)  # Comment out this line to use your own data
+# Offline alternative: python preprocessing/synthetic_data.py <basepath>
 #%% Dataset loader
 
 
@@ -166,23 +191,23 @@ dataset = DataSet().scan()
 #%% Load train data
 
 
-def load_data(basepath, samples_per_class=3):
+def load_data(basepath, samples_per_class=3, seed=cfg.data_seed):
     """Loads image data using folder names as class names
-       Beware: make sure all images are the same size, or resize them manually"""
-    import scipy.misc
-    import skimage.color
+       Beware: make sure all images are the same size, or resize them manually
+       With a seed the same samples come back in the same order on every run,
+       which keeps the bottleneck feature cache valid"""
+    from cnn_utils import load_image
+    rng = random.Random(seed)
     obj_classes = sorted([x for x in os.listdir(basepath) if x[0] != '.'])
     xdata, ydata = [], []
     for root, dirs, files in tqdm.tqdm(os.walk(basepath), mininterval=3, desc='Loading batch data', total=len(obj_classes)):
-        random.shuffle(dirs)
-        for i, f in enumerate(random.sample(files, min(len(files), samples_per_class))):
+        dirs.sort()
+        rng.shuffle(dirs)
+        for i, f in enumerate(rng.sample(sorted(files), min(len(files), samples_per_class))):
             if img_extension not in f.lower():
                 continue
             try:
-                im = scipy.misc.imread(os.path.join(root, f))
-                im = scipy.misc.imresize(im, cfg.imsize, interp='bicubic')
-                if cfg.hsv:
-                    im = skimage.color.rgb2hsv(im)
+                im = load_image(os.path.join(root, f), cfg.imsize, cfg.hsv)
             except OSError:
                 print("Warning: corrupt file %s" % os.path.join(root, f))
                 continue
@@ -192,7 +217,7 @@ def load_data(basepath, samples_per_class=3):
             ydata.append(clsid)
     print("Loaded %d samples" % len(xdata))
     shuffle_ind = list(range(len(xdata)))
-    random.shuffle(shuffle_ind)
+    rng.shuffle(shuffle_ind)
     xdata = np.array(xdata, dtype='float32')
     xdata -= xdata.min()
     xdata /= xdata.max()
@@ -209,88 +234,30 @@ Y_test = np_utils.to_categorical(y_test, len(obj_classes))
 #%% VGG net definition
 # VGG net definition starts here. Change the vgglayers to set how many
 # layers to transfer
-from keras.models import Model
-from keras.regularizers import l1_l2
-from keras.layers import Flatten, Dense, Input, Convolution2D, MaxPooling2D, BatchNormalization
-
-img_input = Input(shape=cfg.tsize)
-if cfg.vgglayers == 0:
-    x = img_input
-if cfg.vgglayers >= 1:  # Block 1
-    x = Convolution2D(64, (3, 3), activation='relu',
-                      padding='same', name='block1_conv1')(img_input)
-    x = Convolution2D(64, (3, 3), activation='relu',
-                      padding='same', name='block1_conv2')(x)
-    x = MaxPooling2D((2, 2), strides=(2, 2), name='block1_pool')(x)
-    if cfg.batchnorm:
-        x = BatchNormalization()(x)
-if cfg.vgglayers >= 2:  # Block 2
-    x = Convolution2D(128, (3, 3), activation='relu',
-                      padding='same', name='block2_conv1')(x)
-    x = Convolution2D(128, (3, 3), activation='relu',
-                      padding='same', name='block2_conv2')(x)
-    x = MaxPooling2D((2, 2), strides=(2, 2), name='block2_pool')(x)
-    if cfg.batchnorm:
-        x = BatchNormalization()(x)
-if cfg.vgglayers >= 3:  # Block 3
-    x = Convolution2D(256, (3, 3), activation='relu',
-                      padding='same', name='block3_conv1')(x)
-    x = Convolution2D(256, (3, 3), activation='relu',
-                      padding='same', name='block3_conv2')(x)
-    x = Convolution2D(256, (3, 3), activation='relu',
-                      padding='same', name='block3_conv3')(x)
-    x = MaxPooling2D((2, 2), strides=(2, 2), name='block3_pool')(x)
-    if cfg.batchnorm:
-        x = BatchNormalization()(x)
-if cfg.vgglayers >= 4:  # Block 4
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block4_conv1')(x)
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block4_conv2')(x)
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block4_conv3')(x)
-    x = MaxPooling2D((2, 2), strides=(2, 2), name='block4_pool')(x)
-    if cfg.batchnorm:
-        x = BatchNormalization()(x)
-if cfg.vgglayers >= 5:  # Block 5
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block5_conv1')(x)
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block5_conv2')(x)
-    x = Convolution2D(512, (3, 3), activation='relu',
-                      padding='same', name='block5_conv3')(x)
-    x = MaxPooling2D((2, 2), strides=(2, 2), name='block5_pool')(x)
-    if cfg.batchnorm:
-        x = BatchNormalization()(x)
-
-x = Flatten(name='flatten')(x)
-for i in range(cfg.fclayers):
-    x = Dense(cfg.fclayersize, activation='relu',
-              kernel_regularizer=l1_l2(cfg.l1, cfg.l2))(x)
-x = Dense(len(obj_classes), activation='softmax', name='predictions')(x)
-
-inputs = img_input
-model = Model(inputs, x, name='vgg16')
+from cnn_utils import build_model
+
+model, img_input = build_model(len(obj_classes), cfg.tsize, cfg.vgglayers,
+                               cfg.fclayers, cfg.fclayersize, batchnorm=cfg.batchnorm,
+                               l1=cfg.l1, l2=cfg.l2)
 model.compile(loss='categorical_crossentropy',
               optimizer=optimizer, metrics=['accuracy'])
 model.summary()
 #%% Transfer weights
-from keras.applications import vgg16
 import keras.layers.convolutional
-vgg16model = vgg16.VGG16(include_top=False)
 modelconv = [l for l in model.layers if type(
     l) == keras.layers.convolutional.Conv2D]
-vgg16conv = [l for l in vgg16model.layers if type(
-    l) == keras.layers.convolutional.Conv2D]
 
-for i, l in enumerate(modelconv):
-    if i > cfg.xferlearning:
-        continue  # Transfer only first n layers
-    print('**** Transferring layer %d: %s from VGG ****' % (i, l))
-    weights = vgg16conv[i].get_weights()
-    modelconv[i].set_weights(weights)
-    if cfg.freeze_conv:
-        l.trainable = False
+if cfg.xferlearning >= 0:
+    # Only the first n conv layers are read from the local VGG16 cache
+    from vgg_weights import vgg16_conv_weights
+    for i, weights in enumerate(vgg16_conv_weights(min(cfg.xferlearning + 1, len(modelconv)))):
+        print('**** Transferring layer %d: %s from VGG ****' % (i, modelconv[i]))
+        modelconv[i].set_weights(weights)
+        if cfg.freeze_conv:
+            modelconv[i].trainable = False
+    if cfg.freeze_conv:  # trainable flags only take effect after recompiling
+        model.compile(loss='categorical_crossentropy',
+                      optimizer=optimizer, metrics=['accuracy'])
 #%% Visualization code
 
 
@@ -488,7 +455,6 @@ def test_prediction(im=None, y=None, epoch=0):
 
 
 #%% Training code
-datagen.fit(X_test)
 if cfg.saveloadmodel and os.path.exists(cfg.modelid):
     print("**** Loading existing model: %s ****" % cfg.modelid)
     model.load_weights(cfg.modelid)
@@ -504,26 +470,85 @@ if os.path.exists(cfg.trainstats):
 
 X_train, y_train, obj_classes = load_data(cfg.trainfolder, cfg.spercls)
 Y_train = np_utils.to_categorical(y_train, len(obj_classes))
+fit_model, train_inputs, test_inputs = model, X_train, X_test
+if cfg.bottleneck:
+    from bottleneck import split_model, check_frozen, FeatureCache
+    if augmenter.enabled:
+        raise ValueError("Bottleneck training cannot be combined with data augmentation")
+    conv_model, fit_model = split_model(model)
+    check_frozen(conv_model)
+    fit_model.compile(loss='categorical_crossentropy',
+                      optimizer=optimizer, metrics=['accuracy'])
+    feature_cache = FeatureCache(os.path.join(cfg.basepath, 'bottleneck'))
+    train_inputs = feature_cache.features(conv_model, X_train, 'train')
+    test_inputs = feature_cache.features(conv_model, X_test, 'test')
+from budget import TrainingBudget
+budget = TrainingBudget(model, optimizer, monitor=cfg.monitor, patience=cfg.patience,
+                        lr_patience=cfg.lr_patience, lr_factor=cfg.lr_factor, min_lr=cfg.min_lr,
+                        max_seconds=cfg.max_seconds, max_samples=cfg.max_samples)
+from telemetry import Telemetry, PhaseCallback
+telemetry = Telemetry(cfg.metrics, graph_size=lambda: K.get_session().graph.version,
+                      trace_heap=cfg.trace_heap, profile_steps=cfg.profile_steps)
+phase_callback = PhaseCallback(telemetry)
+if not cfg.bottleneck:
+    # one long-lived loader for the whole run: loader threads augment the next
+    # batches while the model trains on the current one
+    from keras.utils import OrderedEnqueuer
+    loader_workers = max(1, cpu_profile['loader_workers'])
+    enqueuer = OrderedEnqueuer(augmenter.flow(X_train, Y_train, shuffle=True,
+                                              batch_size=cfg.batch_size),
+                               use_multiprocessing=False)
+    enqueuer.start(workers=loader_workers, max_queue_size=2 * loader_workers)
+    batches = enqueuer.get()
 for e in range(cfg.nb_epoch):
     print('Training.ß.. epoch=%d/%d' % (e, cfg.nb_epoch))
-    loss = model.fit_generator(datagen.flow(X_train, Y_train, shuffle=True,
-                                            batch_size=cfg.batch_size),
-                               steps_per_epoch=1,
-                               epochs=1,
-                               validation_data=(X_test, Y_test),
-                               verbose=0)
+    telemetry.begin_step(e)
+    if cfg.bottleneck:
+        batch = np.sort(np.random.choice(len(train_inputs), min(cfg.batch_size, len(train_inputs)), replace=False))
+        loss = fit_model.fit(train_inputs[batch], Y_train[batch],
+                             batch_size=cfg.batch_size,
+                             epochs=1,
+                             validation_data=(test_inputs, Y_test),
+                             callbacks=[phase_callback],
+                             verbose=0)
+    else:
+        with telemetry.phase('data'):
+            x_batch, y_batch = next(batches)
+        loss = model.fit(x_batch, y_batch,
+                         batch_size=cfg.batch_size,
+                         epochs=1,
+                         validation_data=(X_test, Y_test),
+                         callbacks=[phase_callback],
+                         verbose=0)
     print("Accuracy:", loss.history['val_acc'][0] * 100)
-    tloss = model.evaluate(X_train, Y_train)
+    with telemetry.phase('evaluate'):
+        tloss = fit_model.evaluate(train_inputs, Y_train)
     if cfg.saveloadmodel and e % 50 == 0:
-        model.save_weights(cfg.modelid, overwrite=True)
+        with telemetry.phase('checkpoint'):
+            model.save_weights(cfg.modelid, overwrite=True)
     trainstats.loc[len(trainstats)] = (loss.history['loss'][0], loss.history[
         'val_loss'][0], loss.history['val_acc'][0], tloss[1])
     if e % 10 == 0:
-        trainstats.to_csv(cfg.trainstats, index=False)
-        viz_losses(trainstats, e)
-        t_ind = random.randint(0, len(X_test) - 1)
-        test_prediction(X_test[t_ind], Y_test[t_ind], epoch=e)
+        with telemetry.phase('plot'):
+            trainstats.to_csv(cfg.trainstats, index=False)
+            viz_losses(trainstats, e)
+        with telemetry.phase('heatmap'):
+            t_ind = random.randint(0, len(X_test) - 1)
+            test_prediction(X_test[t_ind], Y_test[t_ind], epoch=e)
     if e % 30 == 29 and cfg.vizfilt_timeout > 0:
-        vizfilt.viz_filters()
+        with telemetry.phase('filters'):
+            vizfilt.viz_filters()
     check_memusage()
-    gc.collect()
+    with telemetry.phase('gc'):
+        gc.collect()
+    telemetry.end_step(e)
+    if budget.update(e, loss.history, min(cfg.batch_size, len(X_train))):
+        break
+
+if not cfg.bottleneck:
+    enqueuer.stop()
+telemetry.report(cfg.telemetryreport)
+budget.finish(cfg.budgetsummary)
+trainstats.to_csv(cfg.trainstats, index=False)
+if cfg.saveloadmodel:
+    model.save_weights(cfg.modelid, overwrite=True)
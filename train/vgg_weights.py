@@ -0,0 +1,52 @@
+import os
+import numpy as np
+
+VGG16_WEIGHTS_URL = ('https://github.com/fchollet/deep-learning-models/releases/download/v0.1/'
+                     'vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5')
+VGG16_WEIGHTS_FILE = 'vgg16_weights_tf_dim_ordering_tf_kernels_notop.h5'
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.keras', 'models', 'vgg16_conv_cache.npz')
+
+
+def extract_vgg16_cache(cache_path=CACHE_PATH, weights_path=None):
+    """
+    extracts the conv kernels/biases of the ImageNet VGG16 weight file into a
+    compact npz cache, one entry per conv layer in network order
+    weights_path defaults to the keras download (fetched once if missing)
+    """
+    import h5py
+    if weights_path is None:
+        from keras.utils.data_utils import get_file
+        weights_path = get_file(VGG16_WEIGHTS_FILE, VGG16_WEIGHTS_URL, cache_subdir='models')
+
+    arrays = {}
+    with h5py.File(weights_path, mode='r') as f:
+        conv_layers = [n.decode('utf8') if isinstance(n, bytes) else n for n in f.attrs['layer_names']]
+        conv_layers = [n for n in conv_layers if '_conv' in n]
+        for i, name in enumerate(conv_layers):
+            group = f[name]
+            kernel_name, bias_name = group.attrs['weight_names']
+            arrays['conv%02d_kernel' % i] = group[kernel_name][()]
+            arrays['conv%02d_bias' % i] = group[bias_name][()]
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, cache_path)
+    print("Cached %d VGG16 conv layers in %s" % (len(conv_layers), cache_path))
+
+
+def vgg16_conv_weights(n, cache_path=CACHE_PATH):
+    """
+    returns [kernel, bias] for the first n VGG16 conv layers
+    only those n layers are read from the cache; the full VGG16 is never built
+    """
+    if n <= 0:
+        return []
+    if not os.path.exists(cache_path):
+        extract_vgg16_cache(cache_path)
+    with np.load(cache_path) as cache:
+        return [[cache['conv%02d_kernel' % i], cache['conv%02d_bias' % i]] for i in range(n)]
+
+
+if __name__ == "__main__":
+    # build the cache ahead of time, e.g. before moving to an offline node
+    extract_vgg16_cache()
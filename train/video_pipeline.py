@@ -0,0 +1,191 @@
+import os
+import math
+import queue
+import threading
+import imageio
+import numpy as np
+from tqdm import tqdm
+
+END = object()          # end-of-stream marker passed between stages
+QUEUE_TIMEOUT = 0.5     # seconds between checks for a failed stage
+
+
+class FrameSampler:
+    """
+    keeps frames so the output plays at target_fps, e.g. every 2nd frame of a 60fps source at 30fps
+    """
+
+    def __init__(self, src_fps, target_fps=None):
+        self.ratio = 1.0 if not target_fps or target_fps >= src_fps else target_fps / src_fps
+        self.kept = 0
+
+    def keep(self, i):
+        if math.floor(i * self.ratio) >= self.kept:
+            self.kept += 1
+            return True
+        return False
+
+
+class TemporalReuse:
+    """
+    decides which frames need stylization: a frame whose mean absolute difference
+    to the last keyframe (on a downsampled copy) is below threshold reuses that
+    keyframe's stylized output, and a keyframe is forced every keyframe_interval frames
+    """
+
+    def __init__(self, threshold=3.0, keyframe_interval=15, stride=8):
+        self.threshold = threshold      # mean abs difference in 0-255 pixel units
+        self.keyframe_interval = keyframe_interval
+        self.stride = stride
+        self.last_key = None
+        self.since_key = 0
+        self.keyframes = 0
+        self.reused = 0
+
+    def is_key(self, frame):
+        small = np.asarray(frame)[::self.stride, ::self.stride].astype('float32')
+        self.since_key += 1
+        if self.last_key is None or self.since_key >= self.keyframe_interval or \
+                small.shape != self.last_key.shape or np.abs(small - self.last_key).mean() >= self.threshold:
+            self.last_key, self.since_key = small, 0
+            self.keyframes += 1
+            return True
+        self.reused += 1
+        return False
+
+
+class VideoPipeline:
+    """
+    decode -> stylize -> encode on separate threads connected by bounded queues
+    stylize_batch(frames) must return the stylized frames in order; with
+    stylize_workers > 1 chunks are stylized concurrently and reordered before encoding
+    memory is bounded by roughly (2 * queue_size + stylize_workers) chunks
+    with a TemporalReuse only keyframes are stylized, other frames repeat the
+    stylized output of the keyframe before them
+    """
+
+    def __init__(self, stylize_batch, chunk_size=16, queue_size=2, stylize_workers=1, reuse=None):
+        self.stylize_batch = stylize_batch
+        self.reuse = reuse
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.stylize_workers = stylize_workers
+        self.failed = threading.Event()
+        self.errors = []
+
+    def put(self, q, item):
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                pass
+        return END
+
+    def stage(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            except Exception as e:
+                self.errors.append(e)
+                self.failed.set()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def decode(self, reader, sampler, out_q):
+        chunk, index = [], 0
+        for i, frame in enumerate(reader):
+            if sampler.keep(i):
+                frame = np.asarray(frame)
+                chunk.append((frame, self.reuse is None or self.reuse.is_key(frame)))
+            if len(chunk) == self.chunk_size:
+                if not self.put(out_q, (index, chunk)):
+                    return
+                chunk, index = [], index + 1
+        if chunk:
+            self.put(out_q, (index, chunk))
+        for _ in range(self.stylize_workers):
+            self.put(out_q, END)
+
+    def stylize(self, in_q, out_q):
+        while True:
+            item = self.get(in_q)
+            if item is END:
+                self.put(out_q, END)
+                return
+            index, chunk = item
+            keyframes = [frame for frame, key in chunk if key]
+            stylized = iter(self.stylize_batch(keyframes) if keyframes else [])
+            # None marks a frame that repeats the previous stylized frame
+            frames = [next(stylized) if key else None for _, key in chunk]
+            if not self.put(out_q, (index, frames)):
+                return
+
+    def encode(self, writer, in_q, progress):
+        pending, next_index, finished = {}, 0, 0
+        previous = None
+        while finished < self.stylize_workers:
+            item = self.get(in_q)
+            if item is END:
+                if self.failed.is_set():
+                    return
+                finished += 1
+                continue
+            index, frames = item
+            pending[index] = frames
+            while next_index in pending:
+                ready = pending.pop(next_index)
+                for frame in ready:
+                    previous = previous if frame is None else frame
+                    writer.append_data(previous)
+                progress.update(len(ready))
+                next_index += 1
+
+    def run(self, vid_path, out_path, target_fps=None):
+        """
+        stylizes vid_path into out_path, returns the number of frames written
+        frames go to a temporary file that replaces out_path only once the writer
+        has closed cleanly, so an existing out_path is always a complete video
+        """
+        reader = imageio.get_reader(vid_path, 'mpeg')
+        meta = reader.get_meta_data()
+        src_fps = meta.get('fps', 30)
+        sampler = FrameSampler(src_fps, target_fps)
+        out_fps = src_fps * sampler.ratio
+        root, ext = os.path.splitext(out_path)
+        tmp_path = '%s.%d.tmp%s' % (root, threading.get_ident(), ext)  # imageio picks the format by extension
+        writer = imageio.get_writer(tmp_path, fps=out_fps)
+        duration = meta.get('duration')
+        progress = tqdm(total=int(duration * out_fps) if duration else None,
+                        desc='Stylizing video', unit='frame')
+
+        decoded_q = queue.Queue(self.queue_size)
+        stylized_q = queue.Queue(self.queue_size)
+        threads = [self.stage(self.decode, reader, sampler, decoded_q)]
+        threads += [self.stage(self.stylize, decoded_q, stylized_q) for _ in range(self.stylize_workers)]
+        threads += [self.stage(self.encode, writer, stylized_q, progress)]
+        try:
+            try:
+                for thread in threads:
+                    thread.join()
+            finally:
+                progress.close()
+                writer.close()
+                reader.close()
+            if self.errors:
+                raise self.errors[0]
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return progress.n